@@ -0,0 +1,69 @@
+"""Measure near-duplicate clustering on synthetic vectors with planted duplicates.
+
+    python benchmarks/bench_duplicates.py --n-rows 1000000 --duplicate-rate 0.1
+    python benchmarks/bench_duplicates.py --n-rows 30000 --backend exact
+
+Vectors are random, a share of them gets slightly changed copies. This builds an hnswlib
+graph or an exact index, clusters it with an all-points search and reports the time it took,
+the peak RSS and how many of the planted duplicates were found.
+"""
+import argparse
+import resource
+import time
+
+import numpy as np
+
+from prodigy_ann.backends import ExactBackend, HnswBackend
+from prodigy_ann.clusters import find_clusters
+
+
+def synthetic_vectors(n_rows: int, dim: int, duplicate_rate: float, noise: float, seed: int = 0):
+    """Random vectors where the last rows are noisy copies, returns the vectors and the original of every row."""
+    rng = np.random.default_rng(seed)
+    n_copies = int(n_rows * duplicate_rate)
+    vectors = rng.standard_normal((n_rows, dim), dtype=np.float32)
+    originals = np.arange(n_rows)
+    originals[n_rows - n_copies:] = rng.integers(0, n_rows - n_copies, size=n_copies)
+    copies = vectors[originals[n_rows - n_copies:]]
+    vectors[n_rows - n_copies:] = copies + rng.normal(scale=noise, size=copies.shape).astype(np.float32)
+    return vectors, originals
+
+
+def peak_rss_mb() -> float:
+    # Linux reports kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-rows", type=int, default=1_000_000)
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--duplicate-rate", type=float, default=0.1)
+    parser.add_argument("--noise", type=float, default=0.01)
+    parser.add_argument("--threshold", type=float, default=0.01)
+    parser.add_argument("--backend", choices=["hnsw", "exact"], default="hnsw")
+    args = parser.parse_args()
+
+    vectors, originals = synthetic_vectors(args.n_rows, args.dim, args.duplicate_rate, args.noise)
+    if args.backend == "exact":
+        backend = ExactBackend("cosine", args.dim)
+    else:
+        backend = HnswBackend("cosine", args.dim, hnsw_m=16, ef_construction=200, ef=50)
+    start = time.perf_counter()
+    backend.add(vectors, np.arange(args.n_rows))
+    seconds = time.perf_counter() - start
+    print(f"build    {seconds:8.1f}s  {args.n_rows / seconds:10.0f} rows/s  peak RSS {peak_rss_mb():8.0f} MB")
+
+    start = time.perf_counter()
+    roots = find_clusters(backend.knn_query, backend.get_items, args.n_rows, args.threshold)
+    seconds = time.perf_counter() - start
+    print(f"cluster  {seconds:8.1f}s  {args.n_rows / seconds:10.0f} rows/s  peak RSS {peak_rss_mb():8.0f} MB")
+
+    # A planted duplicate is found if it ends up in the same cluster as its original.
+    copies = np.flatnonzero(originals != np.arange(args.n_rows))
+    found = np.mean(roots[copies] == roots[originals[copies]]) if len(copies) else 1.0
+    print(f"clusters {len(np.unique(roots)):10d}  planted duplicates found: {found:.1%}")
+
+
+if __name__ == "__main__":
+    main()
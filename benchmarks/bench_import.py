@@ -0,0 +1,69 @@
+"""Measure how long it takes to import the recipes, which every `prodigy` command pays for.
+
+    python benchmarks/bench_import.py --runs 10 --max-seconds 1.0
+
+Every run imports the recipe modules in a fresh interpreter. Reports the median and slowest
+wall time, the slowest imports according to `python -X importtime`, and any heavy modules
+that got imported even though no model or index was used. Exits with an error if the median
+is above `--max-seconds` or a heavy module was imported.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+IMPORT = "import prodigy_ann, prodigy_ann.text, prodigy_ann.image"
+# Modules that should only be imported once a model or an hnswlib index is used.
+HEAVY_MODULES = ("sentence_transformers", "torch", "transformers", "hnswlib", "spacy")
+
+
+def run_seconds(code: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True)
+    return time.perf_counter() - start
+
+
+def slowest_imports(n: int = 10):
+    """Cumulative import time in microseconds of the slowest imports, up to one level deep."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", IMPORT], capture_output=True, text=True, check=True)
+    times = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented by two spaces per level, keep the modules we import directly.
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            times.append((int(cumulative), name.strip()))
+    return sorted(times, reverse=True)[:n]
+
+
+def heavy_imports():
+    code = f"import sys; {IMPORT}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return [name for name in out.stdout.strip().split(",") if name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-seconds", type=float, default=None, help="Fail if the median is slower than this")
+    args = parser.parse_args()
+
+    # Python itself takes a while to start, which is shown for comparison.
+    baseline = statistics.median(run_seconds("pass") for _ in range(args.runs))
+    seconds = [run_seconds(IMPORT) for _ in range(args.runs)]
+    median = statistics.median(seconds)
+    print(f"import   median {median:6.3f}s  max {max(seconds):6.3f}s  (interpreter startup {baseline:.3f}s)")
+    print("\nslowest imports (cumulative):")
+    for micros, name in slowest_imports():
+        print(f"  {micros / 1e6:8.3f}s  {name}")
+    heavy = heavy_imports()
+    print(f"\nheavy modules imported: {', '.join(heavy) if heavy else 'none'}")
+    if heavy or (args.max_seconds is not None and median > args.max_seconds):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
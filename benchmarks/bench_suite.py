@@ -0,0 +1,238 @@
+"""Benchmark the hot paths of `ApproximateIndex` on synthetic corpora, offline.
+
+    python benchmarks/bench_suite.py --text-sizes 1000 10000 100000 --image-sizes 100 1000 --output results.json
+    python benchmarks/bench_suite.py --compare results-0.3.0.json --output results.json
+
+Every corpus is run in its own process, so peak RSS is per run. A stub encoder stands in for
+the model by default, so the numbers measure the index rather than inference, pass `--model`
+to use a real model instead. Reports examples/s for `build_index`, the time to store the index,
+cold-start time of loading it, p50/p99 latency of the first example and of the full result of
+`new_stream` for unseen queries, and peak RSS. With `--compare`, every metric is also shown
+relative to an earlier results file.
+"""
+import argparse
+import configparser
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import srsly
+
+from prodigy_ann.models import register_model
+from prodigy_ann.util import ApproximateIndex
+
+SYLLABLES = "ka lo mi re su ta ne vo pi da ru ko se ma li to".split()
+# Metrics where a lower value is better, everything else is a rate.
+LOWER_IS_BETTER = ("seconds", "_ms", "rss")
+
+
+class StubEncoder:
+    """Deterministic stand-in for a `SentenceTransformer`, cheap enough to not dominate the timings.
+
+    Texts are the sum of a random vector per token, images a random projection of a tiny
+    thumbnail, so similar inputs still get similar vectors.
+    """
+
+    def __init__(self, dim: int = 384, vocab_size: int = 1 << 14):
+        rng = np.random.default_rng(0)
+        self.dim = dim
+        self.vocab_size = vocab_size
+        self.tokens = rng.standard_normal((vocab_size, dim)).astype(np.float32)
+        self.pixels = rng.standard_normal((8 * 8 * 3, dim)).astype(np.float32)
+
+    def encode(self, inputs, **kwargs) -> np.ndarray:
+        out = np.empty((len(inputs), self.dim), dtype=np.float32)
+        for i, item in enumerate(inputs):
+            if isinstance(item, str):
+                ids = [zlib.crc32(token.encode("utf8")) % self.vocab_size for token in item.split()]
+                out[i] = self.tokens[ids].sum(axis=0) if ids else 0.0
+            else:
+                out[i] = np.asarray(item.resize((8, 8)), dtype=np.float32).ravel() / 255 @ self.pixels
+        return out
+
+
+def synthetic_vocab(size: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    words = {"".join(rng.choices(SYLLABLES, k=rng.randint(1, 4))) for _ in range(size * 2)}
+    return sorted(words)[:size]
+
+
+def text_corpus(path: Path, n_examples: int, seed: int = 0):
+    """Texts with Zipf-distributed words, so some words are common and most are rare."""
+    rng = np.random.default_rng(seed)
+    vocab = synthetic_vocab(5000, seed)
+    weights = 1 / np.arange(1, len(vocab) + 1)
+    weights /= weights.sum()
+
+    def examples():
+        for _ in range(n_examples):
+            words = rng.choice(len(vocab), size=rng.integers(8, 60), p=weights)
+            yield {"text": " ".join(vocab[w] for w in words)}
+
+    srsly.write_jsonl(path, examples())
+
+
+def image_corpus(path: Path, n_examples: int, size: int = 640, seed: int = 0):
+    """Stand-ins for photos: noisy gradients with a random tint, saved as JPEGs."""
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    folder = path.parent / "images"
+    folder.mkdir(exist_ok=True)
+    gradient = np.linspace(0, 1, size, dtype=np.float32)[None, :, None]
+    examples = []
+    for i in range(n_examples):
+        tint = rng.uniform(0, 255, size=(1, 1, 3))
+        noise = rng.normal(scale=20, size=(size, size, 3))
+        pixels = np.clip(gradient * tint + noise, 0, 255).astype(np.uint8)
+        image_path = folder / f"{i:06d}.jpg"
+        Image.fromarray(pixels).save(image_path, quality=85)
+        examples.append({"image": str(image_path), "path": str(image_path)})
+    srsly.write_jsonl(path, examples)
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    p50, p99 = np.percentile(values, [50, 99]).tolist()
+    return {"p50": p50, "p99": p99}
+
+
+def peak_rss_mb() -> float:
+    # Linux reports kilobytes, macOS bytes.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(setting: str, size: int, model: Optional[str], backend: Optional[str], n_queries: int, n: int) -> Dict:
+    """Build, store, load and query one corpus, meant to run in a fresh process."""
+    model_name = model or "stub"
+    if model is None:
+        register_model(model_name, StubEncoder())
+    with tempfile.TemporaryDirectory(prefix="prodigy-ann-bench-") as tmpdir:
+        source = Path(tmpdir) / "source.jsonl"
+        (text_corpus if setting == "text" else image_corpus)(source, size)
+        index_path = Path(tmpdir) / "bench.index"
+
+        start = time.perf_counter()
+        index = ApproximateIndex(model_name, source, backend=backend)
+        index.build_index(setting=setting)
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        index.store_index(index_path)
+        store_seconds = time.perf_counter() - start
+        del index
+
+        start = time.perf_counter()
+        index = ApproximateIndex(model_name, source, index_path, query_cache_size=0)
+        load_seconds = time.perf_counter() - start
+
+        # Unseen queries, so every one of them is encoded and searched.
+        vocab = synthetic_vocab(5000, seed=1)
+        rng = random.Random(1)
+        first_ms, full_ms = [], []
+        n = min(n, len(index))
+        # The first query also pays for setting things up, like the background thread.
+        start = time.perf_counter()
+        list(index.new_stream(" ".join(rng.choices(vocab, k=2)), n=n))
+        first_query_ms = (time.perf_counter() - start) * 1000
+        for _ in range(n_queries):
+            query = " ".join(rng.choices(vocab, k=rng.randint(1, 4)))
+            start = time.perf_counter()
+            stream = index.new_stream(query, n=n)
+            next(stream)
+            first_ms.append((time.perf_counter() - start) * 1000)
+            list(stream)
+            full_ms.append((time.perf_counter() - start) * 1000)
+        return {
+            "setting": setting,
+            "size": size,
+            "backend": index.index.name,
+            "build_examples_per_second": size / build_seconds,
+            "store_seconds": store_seconds,
+            "cold_start_seconds": load_seconds,
+            "first_query_ms": first_query_ms,
+            "new_stream_first_ms": percentiles(first_ms),
+            "new_stream_full_ms": percentiles(full_ms),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+def flatten(result: Dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and key != "size":
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results: List[Dict], baseline: Dict):
+    """Print every metric next to the baseline, marking regressions of more than 10%."""
+    previous = {(r["setting"], r["size"]): flatten(r) for r in baseline["results"]}
+    for result in results:
+        old = previous.get((result["setting"], result["size"]))
+        if old is None:
+            continue
+        print(f"\n{result['setting']} size={result['size']} vs {baseline.get('version', 'baseline')}")
+        for metric, value in flatten(result).items():
+            if metric not in old or not old[metric]:
+                continue
+            ratio = value / old[metric]
+            lower = any(part in metric for part in LOWER_IS_BETTER)
+            worse = ratio > 1.1 if lower else ratio < 1 / 1.1
+            flag = "  REGRESSION" if worse else ""
+            print(f"  {metric:<32} {old[metric]:12.2f} -> {value:12.2f}  {ratio:5.2f}x{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--text-sizes", type=int, nargs="*", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--image-sizes", type=int, nargs="*", default=[100, 1_000])
+    parser.add_argument("--model", help="Real model to use instead of the stub encoder")
+    parser.add_argument("--backend", help="Search backend, defaults to auto")
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("--n", type=int, default=100, help="Examples per new stream")
+    parser.add_argument("--output", type=Path, default=Path("bench-results.json"))
+    parser.add_argument("--compare", type=Path, help="Earlier results file to compare with")
+    args = parser.parse_args()
+
+    cases = [("text", size) for size in args.text_sizes] + [("image", size) for size in args.image_sizes]
+    results = []
+    for setting, size in cases:
+        # A fresh process per case, peak RSS never goes down within a process.
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            result = pool.submit(run_case, setting, size, args.model, args.backend, args.n_queries, args.n).result()
+        results.append(result)
+        print(
+            f"{setting:<5} {size:>8}  build {result['build_examples_per_second']:10.0f} ex/s  "
+            f"load {result['cold_start_seconds']:6.2f}s  "
+            f"first p50/p99 {result['new_stream_first_ms']['p50']:7.2f}/{result['new_stream_first_ms']['p99']:7.2f}ms  "
+            f"full p50/p99 {result['new_stream_full_ms']['p50']:7.2f}/{result['new_stream_full_ms']['p99']:7.2f}ms  "
+            f"rss {result['peak_rss_mb']:7.0f}MB"
+        )
+    config = configparser.ConfigParser()
+    config.read(Path(__file__).parent.parent / "setup.cfg")
+    srsly.write_json(args.output, {
+        "version": config.get("metadata", "version", fallback=None),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "model": args.model or "stub",
+        "settings": {"n_queries": args.n_queries, "n": args.n, "backend": args.backend},
+        "results": results,
+    })
+    print(f"\nResults stored at {args.output}")
+    if args.compare:
+        compare(results, srsly.read_json(args.compare))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Measure how `ann.text.index --workers` scales with the number of encoding processes.
+
+    python benchmarks/bench_workers.py --n-examples 20000 --max-workers 8
+
+Only encoding is timed. The model is loaded and every pool of processes is started and
+warmed up before the clock starts, those are one-off costs that don't grow with the corpus.
+Batches are the size the index recipes use for the number of workers.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from prodigy_ann.text import TEXT_MODEL
+from prodigy_ann.util import BATCH_SIZE, ApproximateIndex, batched
+
+WORDS = "annotation corpus model dataset benchmark label query vector index search text example".split()
+
+
+def synthetic_texts(n_examples: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=rng.randint(8, 40))) for _ in range(n_examples)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-examples", type=int, default=20_000)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--model", default=TEXT_MODEL)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    texts = synthetic_texts(args.n_examples)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index = ApproximateIndex(args.model, Path(tmpdir) / "source.jsonl")
+        index.model.encode(texts[:args.batch_size])
+        baseline = None
+        workers = 1
+        while workers <= args.max_workers:
+            with index._encoding_pool(workers):
+                index._encode(texts[:args.batch_size * workers])
+                start = time.perf_counter()
+                for batch in batched(texts, n=args.batch_size * workers):
+                    index._encode(batch)
+                rate = args.n_examples / (time.perf_counter() - start)
+            baseline = baseline or rate
+            print(f"workers={workers:<3} {rate:10.1f} examples/s  speedup={rate / baseline:.2f}x")
+            workers *= 2
+
+
+if __name__ == "__main__":
+    main()
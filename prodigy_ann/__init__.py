@@ -1,7 +1,23 @@
-from .text import text_index, text_fetch, textcat_ann_manual, spans_ann_manual, ner_ann_manual
-from .image import image_index, image_fetch, image_ann_manual
+import importlib
+
+# Recipes are imported on first access, so importing the package stays cheap.
+_RECIPES = {
+    "text_index": "text", "text_fetch": "text", "text_benchmark": "text", "textcat_ann_manual": "text",
+    "spans_ann_manual": "text", "ner_ann_manual": "text",
+    "image_index": "image", "image_fetch": "image", "image_ann_manual": "image",
+}
 
 __all__ = [
-    "text_index", "text_fetch", "textcat_ann_manual", "spans_ann_manual", "ner_ann_manual", 
+    "text_index", "text_fetch", "text_benchmark", "textcat_ann_manual", "spans_ann_manual", "ner_ann_manual",
     "image_index", "image_fetch", "image_ann_manual"
 ]
+
+
+def __getattr__(name):
+    if name in _RECIPES:
+        return getattr(importlib.import_module(f".{_RECIPES[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted([*globals(), *__all__])
@@ -0,0 +1,411 @@
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Callable, Literal, Optional, Tuple
+
+import numpy as np
+from prodigy.util import log
+
+# Below this many examples an exact search is cheap enough that a graph isn't worth building.
+EXACT_THRESHOLD = 100_000
+INITIAL_CAPACITY = 1024
+EXACT_BATCH_SIZE = 65_536
+# Most scores computed at once, many queries against a batch of vectors are split to stay below it.
+SCORE_BLOCK_SIZE = 1 << 22
+# How many candidates per result to fetch from quantized vectors before re-ranking.
+RERANK_FACTOR = 4
+# Filters that allow fewer labels than this are searched exactly, hnswlib struggles with them.
+FILTER_EXACT_LIMIT = 10_000
+
+BackendName = Literal["auto", "hnsw", "exact"]
+Quantization = Literal["float16", "int8"]
+QUANTIZED_DTYPES = {"float16": np.float16, "int8": np.int8}
+
+
+class HnswBackend:
+    """Approximate search over an hnswlib graph, grows as examples are added up to `max_size`."""
+
+    name = "hnsw"
+
+    def __init__(
+        self, space: str, dim: int, hnsw_m: int, ef_construction: int, ef: int, max_size: Optional[int] = None
+    ):
+        from hnswlib import Index
+
+        self.index = Index(space=space, dim=dim)
+        self.max_size = max_size
+        self.index.init_index(
+            max_elements=min(INITIAL_CAPACITY, max_size or INITIAL_CAPACITY), M=hnsw_m, ef_construction=ef_construction
+        )
+        self.index.set_ef(ef)
+
+    @classmethod
+    def load(
+        cls, path: Path, space: str, dim: int, ef: int, max_size: Optional[int] = None, max_elements: int = 0, **kwargs
+    ) -> "HnswBackend":
+        from hnswlib import Index
+
+        backend = cls.__new__(cls)
+        backend.index = Index(space=space, dim=dim)
+        backend.index.load_index(str(path), max_elements=max_elements)
+        backend.index.set_ef(ef)
+        backend.max_size = max_size
+        return backend
+
+    def __len__(self) -> int:
+        return self.index.get_current_count()
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        # Grow the index geometrically, we don't know the size of a streamed source up front.
+        needed = len(self) + len(ids)
+        if needed > self.index.get_max_elements():
+            capacity = max(needed, 2 * self.index.get_max_elements())
+            self.index.resize_index(min(capacity, self.max_size or capacity))
+        self.index.add_items(vectors, ids)
+
+    def knn_query(
+        self, vectors: np.ndarray, k: int, allowed: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        if allowed is None:
+            return self.index.knn_query(vectors, k=k)
+        if len(allowed) > FILTER_EXACT_LIMIT or self.index.space != "cosine":
+            allowed_set = set(allowed.tolist())
+            try:
+                # The filter is called from the search, hnswlib needs a single thread for that.
+                return self.index.knn_query(vectors, k=k, num_threads=1, filter=lambda label: label in allowed_set)
+            except RuntimeError:
+                if self.index.space != "cosine":
+                    raise
+                log(f"INDEX: hnswlib found fewer than {k} results for filter, searching exactly instead.")
+        # Vectors are fetched in batches, so large filters don't need them all in memory at once.
+        batches = (allowed[start:start + EXACT_BATCH_SIZE] for start in range(0, len(allowed), EXACT_BATCH_SIZE))
+        labels, scores = top_k(normalize(vectors), ((normalize(self.get_items(ids)), ids) for ids in batches), k)
+        return labels, (1.0 - scores).astype(np.float32)
+
+    def get_items(self, ids) -> np.ndarray:
+        return np.asarray(self.index.get_items(ids), dtype=np.float32)
+
+    def get_ids(self) -> np.ndarray:
+        return np.asarray(self.index.get_ids_list(), dtype=np.int64)
+
+    def save(self, path: Path) -> None:
+        self.index.save_index(str(path))
+
+
+class ExactBackend:
+    """Exact cosine search over a matrix of normalized vectors.
+
+    Scores are computed with batched matrix multiplications and `argpartition`, distances
+    are `1 - cosine similarity`, just like hnswlib's cosine space. A saved matrix is loaded
+    memory-mapped, so only the pages that are scanned need to be in memory.
+
+    Vectors can be stored as float16 or as int8 with a scale per dimension, which grows if
+    added vectors wouldn't fit. Quantized vectors are scored as they are, optionally followed
+    by re-ranking the best candidates with full-precision vectors that stay on disk.
+    """
+
+    name = "exact"
+
+    def __init__(self, space: str, dim: int, quantize: Optional[Quantization] = None, rerank: bool = False, **kwargs):
+        if space != "cosine":
+            raise ValueError(f"The exact backend only supports the cosine space, not {space}.")
+        if quantize not in (None, "float16", "int8"):
+            raise ValueError(f"Unknown quantization {quantize}, use float16 or int8.")
+        self.dim = dim
+        self.quantize = quantize
+        self.rerank = rerank and quantize is not None
+        self.vectors = np.empty((0, dim), dtype=QUANTIZED_DTYPES.get(quantize, np.float32))
+        self.scales = None
+        self.full = np.empty((0, dim), dtype=np.float32) if self.rerank else None
+        self.ids = np.empty(0, dtype=np.int64)
+        self._pending_vectors, self._pending_ids = [], []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Path, space: str, dim: int, mmap: bool = True, **kwargs) -> "ExactBackend":
+        mmap_mode = "r" if mmap else None
+        vectors = np.load(str(path), mmap_mode=mmap_mode)
+        quantize = {np.dtype(np.float16): "float16", np.dtype(np.int8): "int8"}.get(vectors.dtype)
+        backend = cls(space, dim, quantize=quantize, rerank=full_path(path).exists())
+        backend.vectors = vectors
+        backend.ids = np.load(ids_path(path))
+        if scales_path(path).exists():
+            backend.scales = np.load(scales_path(path))
+        if backend.rerank:
+            backend.full = np.load(full_path(path), mmap_mode=mmap_mode)
+        return backend
+
+    @classmethod
+    def from_backend(cls, other, space: str, dim: int, **kwargs) -> "ExactBackend":
+        """Exact search over the vectors of another backend, useful to validate its recall."""
+        backend = cls(space, dim, **kwargs)
+        # Rows are looked up by binary search, so they need to be sorted by id.
+        ids = np.sort(other.get_ids())
+        for start in range(0, len(ids), EXACT_BATCH_SIZE):
+            batch = ids[start:start + EXACT_BATCH_SIZE]
+            backend.add(other.get_items(batch), batch)
+        return backend
+
+    def __len__(self) -> int:
+        return len(self.ids) + sum(len(ids) for ids in self._pending_ids)
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        self._pending_vectors.append(normalize(vectors))
+        self._pending_ids.append(np.asarray(ids, dtype=np.int64))
+
+    def _consolidate(self) -> None:
+        if not self._pending_ids:
+            return
+        # Streams can search from more than one thread at the same time.
+        with self._lock:
+            if not self._pending_ids:
+                return
+            pending = np.concatenate(self._pending_vectors)
+            if self.quantize == "int8":
+                self._fit_scales(pending)
+            self.vectors = np.concatenate([self.vectors, self._quantized(pending)])
+            if self.full is not None:
+                self.full = np.concatenate([self.full, pending])
+            self.ids = np.concatenate([self.ids, *self._pending_ids])
+            self._pending_vectors, self._pending_ids = [], []
+
+    def _fit_scales(self, vectors: np.ndarray) -> None:
+        """Grow the int8 scales so `vectors` aren't clipped, re-quantizing the stored vectors if needed."""
+        # Normalized vectors are within [-1, 1], the scales use the full int8 range per dimension.
+        needed = (np.maximum(np.abs(vectors).max(axis=0), 1e-6) / 127).astype(np.float32)
+        if self.scales is not None and (needed <= self.scales).all():
+            return
+        if self.scales is None:
+            self.scales = needed
+            return
+        previous, self.scales = self.scales, np.maximum(self.scales, needed)
+        vectors = np.empty(self.vectors.shape, dtype=np.int8)
+        for start in range(0, len(vectors), EXACT_BATCH_SIZE):
+            # The full-precision vectors avoid quantizing twice, if we have them.
+            if self.full is not None:
+                batch = self.full[start:start + EXACT_BATCH_SIZE]
+            else:
+                batch = self.vectors[start:start + EXACT_BATCH_SIZE].astype(np.float32) * previous
+            vectors[start:start + EXACT_BATCH_SIZE] = self._quantized(batch)
+        self.vectors = vectors
+
+    def _quantized(self, vectors: np.ndarray) -> np.ndarray:
+        if self.quantize == "int8":
+            return np.clip(np.rint(vectors / self.scales), -127, 127).astype(np.int8)
+        return vectors.astype(self.vectors.dtype)
+
+    def _dequantized(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors * self.scales if self.scales is not None else vectors
+
+    def _scan(self, queries: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows and scores of the `k` most similar vectors per query, only looking at `rows` if given."""
+        if rows is None:
+            rows = np.arange(len(self.ids))
+            batches = ((self.vectors[start:start + EXACT_BATCH_SIZE], rows[start:start + EXACT_BATCH_SIZE])
+                       for start in range(0, len(rows), EXACT_BATCH_SIZE))
+        else:
+            batches = ((self.vectors[rows[start:start + EXACT_BATCH_SIZE]], rows[start:start + EXACT_BATCH_SIZE])
+                       for start in range(0, len(rows), EXACT_BATCH_SIZE))
+        return top_k(queries, ((self._dequantized(vectors), batch) for vectors, batch in batches), k)
+
+    def _rows(self, ids: np.ndarray) -> np.ndarray:
+        """Rows of the given ids, skipping ids that aren't in this backend."""
+        if not len(self.ids):
+            return np.empty(0, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return rows[self.ids[rows] == ids]
+
+    def knn_query(
+        self, vectors: np.ndarray, k: int, allowed: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        self._consolidate()
+        rows = self._rows(np.asarray(allowed, dtype=np.int64)) if allowed is not None else None
+        available = len(self.ids) if rows is None else len(rows)
+        if k > available:
+            raise RuntimeError(f"Cannot return {k} results from an index of {available} items.")
+        queries = normalize(vectors)
+        if not self.rerank:
+            rows, scores = self._scan(queries, k, rows)
+            return self.ids[rows], (1.0 - scores).astype(np.float32)
+        # Over-fetch with the quantized vectors, then re-rank using the full-precision ones.
+        candidates, _ = self._scan(queries, min(k * RERANK_FACTOR, available), rows)
+        scores = np.stack([self._full_rows(rows) @ query for rows, query in zip(candidates, queries)])
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        rows = np.take_along_axis(candidates, order, axis=1)
+        return self.ids[rows], (1.0 - np.take_along_axis(scores, order, axis=1)).astype(np.float32)
+
+    def _full_rows(self, rows: np.ndarray) -> np.ndarray:
+        # Reading sorted rows from the memory-mapped file is friendlier to the disk.
+        order = np.argsort(rows)
+        out = np.empty((len(rows), self.dim), dtype=np.float32)
+        out[order] = self.full[rows[order]]
+        return out
+
+    def get_items(self, ids) -> np.ndarray:
+        self._consolidate()
+        rows = np.searchsorted(self.ids, np.asarray(ids, dtype=np.int64))
+        if self.full is not None:
+            return self._full_rows(rows)
+        return self._dequantized(self.vectors[rows])
+
+    def get_ids(self) -> np.ndarray:
+        self._consolidate()
+        return self.ids
+
+    def save(self, path: Path) -> None:
+        self._consolidate()
+        # Write through a file object, so numpy doesn't append a `.npy` suffix.
+        arrays = [(Path(path), self.vectors), (ids_path(path), self.ids)]
+        if self.scales is not None:
+            arrays.append((scales_path(path), self.scales))
+        if self.full is not None:
+            arrays.append((full_path(path), self.full))
+        for array_path, array in arrays:
+            # Loaded arrays may be mapped from the files we're writing, so replace them instead.
+            tmp_path = array_path.with_name(f"{array_path.name}.tmp")
+            with tmp_path.open("wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, array_path)
+
+
+class LazyShard:
+    """A shard that is stored on disk and only loaded once it's used.
+
+    While building, full shards are written to disk and released, so only the shard that
+    is being filled is in memory. Exact shards are memory-mapped when they're loaded, while
+    an hnswlib graph is always loaded in full. Every search fans out to all shards, so the
+    first search of an hnsw index loads all of their graphs and keeps them in memory.
+    """
+
+    def __init__(self, path: Path, name: str, size: int, load: Callable[[Path], object]):
+        self.path = Path(path)
+        self.name = name
+        self.size = size
+        self._load = load
+        self._backend = None
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            # Shards are searched from a thread pool, they should only be loaded once.
+            with self._lock:
+                if self._backend is None:
+                    self._backend = self._load(self.path)
+        return self._backend
+
+    def __len__(self) -> int:
+        return self.size if self._backend is None else len(self._backend)
+
+    def __getattr__(self, name: str):
+        # Everything else, e.g. searching or adding, needs the loaded shard.
+        return getattr(self.backend, name)
+
+    def save(self, path: Path) -> None:
+        same_path = Path(path).resolve() == self.path.resolve()
+        if self._backend is not None and not (same_path and len(self._backend) == self.size):
+            self._backend.save(path)
+            return
+        if same_path:
+            # Unchanged, and overwriting a memory-mapped file would pull the data out from under it.
+            return
+        # Not loaded, so the files on disk are up to date.
+        for src_path, dst_path in zip(backend_files(self.path), backend_files(path)):
+            if src_path.exists():
+                shutil.copyfile(src_path, dst_path)
+
+
+def backend_files(path: Path):
+    """The files a saved backend may consist of."""
+    return [Path(path), ids_path(path), scales_path(path), full_path(path)]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(queries: np.ndarray, batches, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Labels and dot products of the `k` best vectors per query, best first.
+
+    `batches` yields `(vectors, labels)`. Only the best `k` of every batch are kept around,
+    and many queries are scored in chunks, so memory stays bounded for large matrices.
+    """
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_labels = np.empty((len(queries), 0), dtype=np.int64)
+    for vectors, labels in batches:
+        labels = np.asarray(labels)
+        if not len(labels):
+            continue
+        vectors = np.asarray(vectors, dtype=np.float32)
+        top = min(k, len(labels))
+        scores = np.empty((len(queries), top), dtype=np.float32)
+        part = np.empty((len(queries), top), dtype=np.int64)
+        step = max(1, SCORE_BLOCK_SIZE // len(labels))
+        for start in range(0, len(queries), step):
+            chunk = queries[start:start + step] @ vectors.T
+            chunk_part = np.argpartition(-chunk, top - 1, axis=1)[:, :top]
+            scores[start:start + step] = np.take_along_axis(chunk, chunk_part, axis=1)
+            part[start:start + step] = chunk_part
+        best_scores = np.concatenate([best_scores, scores], axis=1)
+        best_labels = np.concatenate([best_labels, labels[part]], axis=1)
+        if best_scores.shape[1] > k:
+            keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+            best_labels = np.take_along_axis(best_labels, keep, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    return np.take_along_axis(best_labels, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+def maximal_marginal_relevance(query: np.ndarray, vectors: np.ndarray, k: int, diversity: float) -> np.ndarray:
+    """Indices of `k` vectors that are close to the query but not to each other, in pick order.
+
+    Every pick maximizes `(1 - diversity) * sim(query, v) - diversity * max(sim(v, picked))`,
+    so a diversity of 0 keeps the order by relevance.
+    """
+    vectors = normalize(vectors)
+    relevance = vectors @ normalize(np.asarray(query)[None, :])[0]
+    k = min(k, len(vectors))
+    picked = np.empty(k, dtype=np.int64)
+    available = np.ones(len(vectors), dtype=bool)
+    redundancy = np.zeros(len(vectors), dtype=np.float32)
+    for i in range(k):
+        scores = (1 - diversity) * relevance - diversity * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        picked[i], available[best] = best, False
+        similarity = vectors @ vectors[best]
+        redundancy = np.maximum(redundancy, similarity) if i else similarity
+    return picked
+
+
+def convert(backend, name: str, space: str, dim: int, **settings):
+    """Copy the vectors of a backend into a backend of another type or quantization."""
+    if backend.name == name and getattr(backend, "quantize", None) == settings.get("quantize"):
+        return backend
+    if name == "exact":
+        return ExactBackend.from_backend(backend, space, dim, **settings)
+    new = HnswBackend(space, dim, **settings)
+    ids = backend.get_ids()
+    for start in range(0, len(ids), EXACT_BATCH_SIZE):
+        batch = ids[start:start + EXACT_BATCH_SIZE]
+        new.add(backend.get_items(batch), batch)
+    return new
+
+
+def ids_path(path: Path) -> Path:
+    return Path(f"{path}.ids.npy")
+
+
+def scales_path(path: Path) -> Path:
+    return Path(f"{path}.scales.npy")
+
+
+def full_path(path: Path) -> Path:
+    return Path(f"{path}.full.npy")
+
+
+BACKENDS = {"hnsw": HnswBackend, "exact": ExactBackend}
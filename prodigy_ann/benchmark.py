@@ -0,0 +1,73 @@
+import time
+from typing import Dict, List, Sequence
+
+import numpy as np
+from prodigy.util import log
+
+from .backends import normalize
+
+
+def exact_neighbours(vectors: np.ndarray, queries: np.ndarray, k: int, batch_size: int = 1024) -> np.ndarray:
+    """Ground truth top-k labels by cosine similarity, computed in batches of queries."""
+    vectors, queries = normalize(vectors), normalize(queries)
+    k = min(k, len(vectors))
+    out = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), batch_size):
+        scores = queries[start:start + batch_size] @ vectors.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        out[start:start + batch_size] = np.take_along_axis(top, order, axis=1)
+    return out
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f.tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def benchmark_hnsw(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    k: int = 10,
+    hnsw_ms: Sequence[int] = (16,),
+    ef_constructions: Sequence[int] = (200,),
+    efs: Sequence[int] = (10, 50, 100, 200),
+    space: str = "cosine",
+) -> List[Dict]:
+    """Build an index for every `(M, ef_construction)` and measure every `ef` against brute force.
+
+    Latency is measured per single query, which is what a stream reset does.
+    """
+    from hnswlib import Index
+
+    truth = exact_neighbours(vectors, queries, k)
+    results = []
+    for m in hnsw_ms:
+        for ef_construction in ef_constructions:
+            index = Index(space=space, dim=vectors.shape[1])
+            index.init_index(max_elements=len(vectors), M=m, ef_construction=ef_construction)
+            start = time.perf_counter()
+            index.add_items(vectors, np.arange(len(vectors)))
+            build_seconds = time.perf_counter() - start
+            log(f"BENCHMARK: Built index with {m=} and {ef_construction=} in {build_seconds:.2f}s.")
+            for ef in efs:
+                index.set_ef(ef)
+                latencies = []
+                found = []
+                for query in queries:
+                    start = time.perf_counter()
+                    labels, _ = index.knn_query(query[None, :], k=k)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    found.append(labels[0])
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist()
+                results.append({
+                    "M": m,
+                    "ef_construction": ef_construction,
+                    "ef": ef,
+                    "build_seconds": build_seconds,
+                    "latency_ms_p50": p50,
+                    "latency_ms_p95": p95,
+                    "latency_ms_p99": p99,
+                    f"recall@{k}": recall_at_k(np.array(found), truth),
+                })
+    return results
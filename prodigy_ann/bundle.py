@@ -0,0 +1,53 @@
+import hashlib
+from pathlib import Path
+from typing import Dict, Optional
+
+import srsly
+
+# Bump when the layout of the files next to an index changes.
+BUNDLE_VERSION = 1
+SAMPLE_SIZE = 1024 * 1024
+
+
+def metadata_path(index_path: Path) -> Path:
+    return Path(f"{index_path}.meta.json")
+
+
+def read_metadata(index_path: Path) -> Optional[Dict]:
+    path = metadata_path(index_path)
+    if not path.exists():
+        return None
+    return srsly.read_json(path)
+
+
+def write_metadata(index_path: Path, meta: Dict) -> None:
+    srsly.write_json(metadata_path(index_path), {"version": BUNDLE_VERSION, **meta})
+
+
+def index_exists(index_path: Path) -> bool:
+    """Sharded indexes don't have a file at `index_path`, only their metadata."""
+    return Path(index_path).exists() or metadata_path(index_path).exists()
+
+
+def source_fingerprint(source) -> Optional[str]:
+    """Cheap fingerprint of a source file or folder, `None` if it isn't on disk.
+
+    Files are fingerprinted by their size and the first and last megabyte, folders by the
+    names and sizes of the files in them. This avoids reading large sources in full.
+    """
+    path = Path(str(source))
+    if not path.exists():
+        return None
+    digest = hashlib.blake2b(digest_size=16)
+    if path.is_dir():
+        for child in sorted(p for p in path.rglob("*") if p.is_file()):
+            digest.update(f"{child.relative_to(path)}:{child.stat().st_size}\n".encode("utf8"))
+        return digest.hexdigest()
+    size = path.stat().st_size
+    digest.update(str(size).encode("utf8"))
+    with path.open("rb") as f:
+        digest.update(f.read(SAMPLE_SIZE))
+        if size > SAMPLE_SIZE:
+            f.seek(max(size - SAMPLE_SIZE, SAMPLE_SIZE))
+            digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
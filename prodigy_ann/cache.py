@@ -0,0 +1,111 @@
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from prodigy.util import log
+
+
+class EmbeddingCache:
+    """On-disk store of embeddings, keyed by model name and `_input_hash`.
+
+    Vectors are stored as float32 blobs in a SQLite file. When `max_items` is set
+    the least recently used embeddings are evicted once the cache grows beyond it. The
+    number of rows is counted when the cache is opened and kept up to date on insert,
+    so checking the size doesn't scan the table for every batch.
+    """
+
+    def __init__(self, path: Path, model_name: str, max_items: Optional[int] = None):
+        self.path = Path(path)
+        self.model_name = model_name
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, input_hash INTEGER NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (model, input_hash))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings (last_used)")
+        self.conn.commit()
+        self._count = len(self) if max_items is not None else None
+        log(f"CACHE: Using embedding cache at {self.path} for {model_name=}.")
+
+    def get_many(self, hashes: Iterable[int]) -> Dict[int, np.ndarray]:
+        """Look up embeddings for the given hashes, returns only those that are cached."""
+        hashes = list(hashes)
+        found = {}
+        # SQLite limits the number of variables in a single query, so we chunk.
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT input_hash, vector FROM embeddings WHERE model = ? AND input_hash IN ({placeholders})",
+                [self.model_name, *chunk],
+            )
+            for input_hash, blob in rows:
+                found[input_hash] = np.frombuffer(blob, dtype=np.float32)
+        if found:
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND input_hash = ?",
+                [(now, self.model_name, h) for h in found],
+            )
+        self.hits += len(found)
+        self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, hashes: List[int], vectors: np.ndarray) -> None:
+        """Store embeddings for the given hashes and evict old entries if needed."""
+        if self._count is not None:
+            unique = list({int(h) for h in hashes})
+            self._count += len(unique) - self._n_cached(unique)
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, input_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+            [
+                (self.model_name, int(h), np.asarray(vec, dtype=np.float32).tobytes(), now)
+                for h, vec in zip(hashes, vectors)
+            ],
+        )
+        self.conn.commit()
+        self.evict()
+
+    def _n_cached(self, hashes: List[int]) -> int:
+        """Number of the given hashes that already have an embedding, replacing those doesn't add rows."""
+        n = 0
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            (count,) = self.conn.execute(
+                f"SELECT COUNT(*) FROM embeddings WHERE model = ? AND input_hash IN ({placeholders})",
+                [self.model_name, *chunk],
+            ).fetchone()
+            n += count
+        return n
+
+    def evict(self) -> int:
+        """Remove least recently used embeddings beyond `max_items`, returns number removed."""
+        if self.max_items is None:
+            return 0
+        excess = self._count - self.max_items
+        if excess <= 0:
+            return 0
+        self.conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self.conn.commit()
+        self._count -= excess
+        log(f"CACHE: Evicted {excess} embeddings to stay within {self.max_items} items.")
+        return excess
+
+    def __len__(self) -> int:
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return count
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,101 @@
+import os
+import re
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Chunks of about this many words stay well within the 256 word pieces most sentence-transformers see.
+CHUNK_WORDS = 128
+# Words repeated at the start of a chunk when the previous one had to be cut mid-sentence.
+CHUNK_OVERLAP = 16
+
+WORD = re.compile(r"\S+")
+SENTENCE_END = re.compile(r"[.!?…][\"')\]]*$")
+
+
+def chunks_path(index_path: Path) -> Path:
+    """Path of the sidecar file that maps every label to its document and character offsets."""
+    return Path(f"{index_path}.chunks.npz")
+
+
+def chunk_spans(text: str, size: int = CHUNK_WORDS, overlap: int = CHUNK_OVERLAP) -> List[Tuple[int, int]]:
+    """Character offsets of chunks of at most `size` words, ending at a sentence where possible.
+
+    Texts without words are a single chunk, so every document can still be found.
+    """
+    words = [match.span() for match in WORD.finditer(text)]
+    if len(words) <= size:
+        return [(0, len(text))]
+    spans = []
+    start = 0
+    while True:
+        end = min(start + size, len(words))
+        cut = end < len(words)
+        if cut:
+            # End after the last sentence in the window, as long as the chunk stays at least half full.
+            for i in range(end - 1, start + size // 2 - 1, -1):
+                if SENTENCE_END.search(text[words[i][0]:words[i][1]]):
+                    end, cut = i + 1, False
+                    break
+        spans.append((words[start][0], words[end - 1][1]))
+        if end == len(words):
+            return spans
+        start = max(end - overlap, start + 1) if cut else end
+
+
+class ChunkMap:
+    """Document and character offsets of every label, for indexes of chunked texts.
+
+    Kept as arrays rather than per-chunk objects, that's 16 bytes per chunk. Chunks are
+    added in batches and consolidated on first access.
+    """
+
+    def __init__(self, docs: Optional[np.ndarray] = None, spans: Optional[np.ndarray] = None):
+        self._docs = np.empty(0, dtype=np.int64) if docs is None else docs
+        self._spans = np.empty((0, 2), dtype=np.int32) if spans is None else spans
+        self._pending: List[Tuple[np.ndarray, np.ndarray]] = []
+
+    @classmethod
+    def load(cls, index_path: Path) -> Optional["ChunkMap"]:
+        path = chunks_path(index_path)
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            return cls(data["docs"], data["spans"])
+
+    def save(self, index_path: Path) -> None:
+        path = chunks_path(index_path)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with tmp_path.open("wb") as f:
+            np.savez(f, docs=self.docs, spans=self.spans)
+        os.replace(tmp_path, path)
+
+    def add(self, docs: Iterable[int], spans: Iterable[Tuple[int, int]]) -> None:
+        docs = np.fromiter(docs, dtype=np.int64)
+        spans = np.array(list(spans), dtype=np.int32).reshape(-1, 2)
+        self._pending.append((docs, spans))
+
+    def _consolidate(self) -> None:
+        if self._pending:
+            self._docs = np.concatenate([self._docs, *(docs for docs, _ in self._pending)])
+            self._spans = np.concatenate([self._spans, *(spans for _, spans in self._pending)])
+            self._pending = []
+
+    @property
+    def docs(self) -> np.ndarray:
+        self._consolidate()
+        return self._docs
+
+    @property
+    def spans(self) -> np.ndarray:
+        self._consolidate()
+        return self._spans
+
+    @property
+    def n_docs(self) -> int:
+        docs = self.docs
+        return int(docs[-1]) + 1 if len(docs) else 0
+
+    def __len__(self) -> int:
+        return len(self.docs)
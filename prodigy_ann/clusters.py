@@ -0,0 +1,80 @@
+import os
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+# Neighbours per example that are checked for near-duplicates.
+DUPLICATE_NEIGHBOURS = 10
+DUPLICATE_BATCH_SIZE = 8192
+
+
+def clusters_path(index_path: Path) -> Path:
+    """Path of the sidecar file that maps every label to the label representing its cluster."""
+    return Path(f"{index_path}.clusters.npy")
+
+
+def load_clusters(index_path: Path) -> Optional[np.ndarray]:
+    path = clusters_path(index_path)
+    return np.load(path) if path.exists() else None
+
+
+def save_clusters(index_path: Path, roots: np.ndarray) -> None:
+    path = clusters_path(index_path)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("wb") as f:
+        np.save(f, roots)
+    os.replace(tmp_path, path)
+
+
+def union_pairs(roots: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Merge the clusters of all pairs `(a[i], b[i])`, vectorised union-find.
+
+    Every label points to a label that is at most its own, so the smallest label of a
+    cluster is its root. Roots of linked clusters are hooked onto the smaller one, and
+    pointers are jumped until every label points to its root directly.
+    """
+    roots = roots.copy()
+    while True:
+        roots = _compress(roots)
+        ra, rb = roots[a], roots[b]
+        linked = ra != rb
+        if not linked.any():
+            return roots
+        a, b = a[linked], b[linked]
+        np.minimum.at(roots, np.maximum(ra[linked], rb[linked]), np.minimum(ra[linked], rb[linked]))
+
+
+def _compress(roots: np.ndarray) -> np.ndarray:
+    while True:
+        parents = roots[roots]
+        if np.array_equal(parents, roots):
+            return roots
+        roots = parents
+
+
+def find_clusters(
+    search: Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]],
+    get_vectors: Callable[[np.ndarray], np.ndarray],
+    size: int,
+    threshold: float,
+    roots: Optional[np.ndarray] = None,
+    k: int = DUPLICATE_NEIGHBOURS,
+    batch_size: int = DUPLICATE_BATCH_SIZE,
+) -> np.ndarray:
+    """Clusters of near-duplicates, as the root label of every label.
+
+    All examples are searched for their `k` nearest neighbours in batches, neighbours within
+    `threshold` distance are linked. Clusters are the connected groups of linked examples. With
+    `roots` of an earlier run, only the labels after them are searched.
+    """
+    start = 0 if roots is None else len(roots)
+    roots = np.concatenate([np.arange(start, dtype=np.int64) if roots is None else roots, np.arange(start, size)])
+    k = min(k + 1, size)
+    for batch_start in range(start, size, batch_size):
+        labels = np.arange(batch_start, min(batch_start + batch_size, size))
+        neighbours, distances = search(get_vectors(labels), k)
+        close = (distances <= threshold) & (neighbours != labels[:, None])
+        rows = np.broadcast_to(labels[:, None], neighbours.shape)
+        roots = union_pairs(roots, rows[close], np.asarray(neighbours, dtype=np.int64)[close])
+    return roots
@@ -0,0 +1,104 @@
+import os
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import srsly
+
+
+def filter_paths(index_path: Path) -> Tuple[Path, Path]:
+    """Paths of the postings keys and of the concatenated postings next to an index."""
+    return Path(f"{index_path}.filters.json"), Path(f"{index_path}.filters.npy")
+
+
+def parse_filter(expression: str) -> Dict[str, List[str]]:
+    """Parse a filter like `lang=de|en,source=crm` into the allowed values per field.
+
+    Fields are combined with AND, the values of a single field with OR.
+    """
+    conditions = {}
+    for condition in expression.split(","):
+        field, sep, values = condition.partition("=")
+        if not sep or not field.strip():
+            raise ValueError(f"Invalid filter {condition!r}, use field=value or field=value|value.")
+        conditions[field.strip()] = [value.strip() for value in values.split("|")]
+    return conditions
+
+
+class MetaIndex:
+    """Inverted index from values of `meta` fields to the labels of the examples that have them.
+
+    The postings of every value are sorted arrays of labels, so filters are resolved with
+    unions and intersections. Saved postings are concatenated into one memory-mapped array.
+    """
+
+    def __init__(self, fields: Iterable[str]):
+        self.fields = list(fields)
+        self.postings: Dict[str, Dict[str, np.ndarray]] = {field: {} for field in self.fields}
+        self._pending = {field: defaultdict(list) for field in self.fields}
+
+    @classmethod
+    def load(cls, index_path: Path) -> Optional["MetaIndex"]:
+        keys_path, postings_path = filter_paths(index_path)
+        if not keys_path.exists():
+            return None
+        keys = srsly.read_json(keys_path)
+        postings = np.load(postings_path, mmap_mode="r")
+        meta_index = cls(keys["fields"])
+        for field, values in keys["postings"].items():
+            for value, (start, end) in values.items():
+                meta_index.postings[field][value] = postings[start:end]
+        return meta_index
+
+    def add(self, label: int, ex: Dict) -> None:
+        meta = ex.get("meta", {})
+        for field in self.fields:
+            values = meta.get(field)
+            if values is None:
+                continue
+            for value in values if isinstance(values, list) else [values]:
+                self._pending[field][str(value)].append(label)
+
+    def _consolidate(self) -> None:
+        for field, values in self._pending.items():
+            for value, labels in values.items():
+                existing = self.postings[field].get(value, np.empty(0, dtype=np.int64))
+                self.postings[field][value] = np.concatenate([existing, np.array(labels, dtype=np.int64)])
+        self._pending = {field: defaultdict(list) for field in self.fields}
+
+    def labels(self, conditions: Dict[str, List[str]]) -> np.ndarray:
+        """Sorted labels of the examples that match all conditions."""
+        self._consolidate()
+        unknown = [field for field in conditions if field not in self.postings]
+        if unknown:
+            raise ValueError(f"Can't filter on {', '.join(unknown)}, indexed fields are: {', '.join(self.fields)}.")
+        allowed = None
+        # Start with the most selective field, so the intersections stay small.
+        matches = [self._union(field, values) for field, values in conditions.items()]
+        for labels in sorted(matches, key=len):
+            allowed = labels if allowed is None else np.intersect1d(allowed, labels, assume_unique=True)
+        return allowed if allowed is not None else np.empty(0, dtype=np.int64)
+
+    def _union(self, field: str, values: List[str]) -> np.ndarray:
+        postings = [self.postings[field][value] for value in values if value in self.postings[field]]
+        if not postings:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(postings))
+
+    def save(self, index_path: Path) -> None:
+        self._consolidate()
+        keys, postings, start = {}, [], 0
+        for field, values in self.postings.items():
+            keys[field] = {}
+            for value, labels in values.items():
+                keys[field][value] = [start, start + len(labels)]
+                postings.append(np.asarray(labels))
+                start += len(labels)
+        keys_path, postings_path = filter_paths(index_path)
+        # Loaded postings may be mapped from the file we're writing, so replace it instead.
+        tmp_path = postings_path.with_name(f"{postings_path.name}.tmp")
+        with tmp_path.open("wb") as f:
+            np.save(f, np.concatenate(postings) if postings else np.empty(0, dtype=np.int64))
+        os.replace(tmp_path, postings_path)
+        srsly.write_json(keys_path, {"fields": self.fields, "postings": keys})
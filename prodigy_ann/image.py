@@ -1,11 +1,14 @@
 from pathlib import Path
-
-import srsly
+from typing import Optional
 
 from prodigy import recipe
 from prodigy.util import log
-from prodigy.recipes.image import image_manual
-from .util import remove_images, ApproximateIndex, JS, CSS, HTML, stream_reset_calback
+from .util import ApproximateIndex, JS, CSS, HTML, stream_reset_calback, write_fetched, QUERY_CACHE_SIZE
+from .util import exclude_annotated, write_stats_on_exit, cache_key, BATCH_SIZE
+from .cache import EmbeddingCache
+from .bundle import index_exists
+
+IMAGE_MODEL = "clip-ViT-B-32"
 
 
 @recipe(
@@ -13,17 +16,76 @@ from .util import remove_images, ApproximateIndex, JS, CSS, HTML, stream_reset_c
     # fmt: off
     source=("Path to text source to index", "positional", None, str),
     index_path=("Path to output the trained index", "positional", None, Path),
+    cache_path=("Path to an embedding cache to reuse between runs", "option", "c", Path),
+    cache_size=("Maximum number of embeddings to keep in the cache", "option", "cs", int),
+    thumbnail_path=("Folder to cache images reduced to the model's input size in", "option", "tc", Path),
+    model=("Sentence-transformers model to encode examples with, defaults to clip-ViT-B-32", "option", "m", str),
+    batch_size=("Number of examples to encode per batch", "option", "bs", int),
+    inference=("Inference to use: torch, or int8 for faster quantized CPU inference", "option", "inf", str),
+    update=("Only add new examples to an existing index", "flag", "u", bool),
+    workers=("Number of processes to encode examples with", "option", "w", int),
+    hnsw_m=("HNSW number of links per element", "option", "M", int),
+    ef_construction=("HNSW candidate list size while building", "option", "efc", int),
+    ef=("HNSW candidate list size at query time, higher is more accurate but slower", "option", "ef", int),
+    backend=("Search backend: auto (exact for small indexes), hnsw or exact", "option", "b", str),
+    quantize=("Store vectors as float16 or int8 to save memory, uses the exact backend", "option", "qt", str),
+    rerank=("Keep full-precision vectors on disk to re-rank quantized results", "flag", "rr", bool),
+    filter_fields=("Comma separated meta fields to build filters for", "option", "ff", str),
+    dedup_threshold=("Show one of every group of near-duplicates within this distance", "option", "dd", float),
+    stats_path=("Write timing and memory stats to this JSONL or Prometheus .prom file", "option", "sp", Path),
     # fmt: on
 )
-def image_index(source: Path, index_path: Path):
+def image_index(
+    source: Path,
+    index_path: Path,
+    cache_path: Optional[Path] = None,
+    cache_size: Optional[int] = None,
+    thumbnail_path: Optional[Path] = None,
+    model: Optional[str] = None,
+    batch_size: int = BATCH_SIZE,
+    inference: Optional[str] = None,
+    update: bool = False,
+    workers: int = 1,
+    hnsw_m: Optional[int] = None,
+    ef_construction: Optional[int] = None,
+    ef: Optional[int] = None,
+    backend: Optional[str] = None,
+    quantize: Optional[str] = None,
+    rerank: bool = False,
+    filter_fields: Optional[str] = None,
+    dedup_threshold: Optional[float] = None,
+    stats_path: Optional[Path] = None,
+):
     """Builds an HSNWLIB index on example image data."""
     # Store sentences as a list, not perfect, but works.
     log("RECIPE: Calling `ann.image.index`")
-    index = ApproximateIndex('clip-ViT-B-32', source)
-    index.build_index(setting="image")
-    
+    if thumbnail_path:
+        from .thumbnails import ThumbnailCache
+
+        thumbnails = ThumbnailCache(thumbnail_path)
+    else:
+        thumbnails = None
+    settings = dict(
+        hnsw_m=hnsw_m, ef_construction=ef_construction, ef=ef, backend=backend, quantize=quantize, rerank=rerank,
+        filter_fields=filter_fields.split(",") if filter_fields else None, dedup_threshold=dedup_threshold,
+        inference=inference,
+    )
+    if update and index_exists(index_path):
+        # Updates keep using the model the index was built with.
+        index = ApproximateIndex(model, source, index_path, default_model=IMAGE_MODEL, check_source=False, **settings)
+        cache = EmbeddingCache(cache_path, cache_key(index), max_items=cache_size) if cache_path else None
+        index.update_index(setting="image", cache=cache, workers=workers, thumbnails=thumbnails, batch_size=batch_size)
+    else:
+        index = ApproximateIndex(model or IMAGE_MODEL, source, **settings)
+        cache = EmbeddingCache(cache_path, cache_key(index), max_items=cache_size) if cache_path else None
+        index.build_index(setting="image", cache=cache, workers=workers, thumbnails=thumbnails, batch_size=batch_size)
+    if cache is not None:
+        cache.close()
+
     # Hnswlib demands a string as an output path
     index.store_index(index_path)
+    if stats_path is not None:
+        index.metrics.write(stats_path)
 
 
 @recipe(
@@ -34,21 +96,49 @@ def image_index(source: Path, index_path: Path):
     out_path=("Path to write examples into", "positional", None, Path),
     query=("ANN query to run", "option", "q", str),
     n=("Number of results to return", "option", "n", int),
-    remove_base64=("Remove base64-encoded image data", "flag", "R", bool)
+    remove_base64=("Remove base64-encoded image data", "flag", "R", bool),
+    queries=("File with one query per line to run in a single batch", "option", "qs", Path),
+    combine=("Write deduplicated results for all queries into a single file", "flag", "C", bool),
+    ef=("HNSW candidate list size at query time, higher is more accurate but slower", "option", "ef", int),
+    backend=("Search backend to use instead of the one the index was built with", "option", "b", str),
+    meta_filter=("Only return examples whose meta matches, e.g. lang=de|en,source=crm", "option", "mf", str),
+    diversity=("Trade relevance for diversity from 0 to 1, to skip near-duplicates", "option", "dv", float),
+    model=("Model to check against the index, defaults to the one it was built with", "option", "m", str),
+    inference=("Inference for queries: torch or int8, defaults to the one the index used", "option", "inf", str),
+    stats_path=("Write timing and memory stats to this JSONL or Prometheus .prom file", "option", "sp", Path),
     # fmt: on
 )
-def image_fetch(source: Path, index_path: Path, out_path: Path, query: str, n: int = 200, remove_base64:bool=False):
+def image_fetch(
+    source: Path,
+    index_path: Path,
+    out_path: Path,
+    query: Optional[str] = None,
+    n: int = 200,
+    remove_base64: bool = False,
+    queries: Optional[Path] = None,
+    combine: bool = False,
+    ef: Optional[int] = None,
+    backend: Optional[str] = None,
+    meta_filter: Optional[str] = None,
+    diversity: float = 0.0,
+    model: Optional[str] = None,
+    inference: Optional[str] = None,
+    stats_path: Optional[Path] = None,
+):
     """Fetch a relevant subset using a HNSWlib index."""
     log("RECIPE: Calling `ann.image.fetch`")
-    if not query:
-        raise ValueError("must pass query")
+    if not query and not queries:
+        raise ValueError("must pass query or queries")
 
-    index = ApproximateIndex('clip-ViT-B-32', source, index_path)
-    stream = index.new_stream(query, n=n)
-    if remove_base64:
-        stream = remove_images(stream)
-    srsly.write_jsonl(out_path, stream)
-    log(f"RECIPE: New stream stored at {out_path}")
+    index = ApproximateIndex(
+        model, source, index_path, ef=ef, backend=backend, inference=inference, default_model=IMAGE_MODEL
+    )
+    write_fetched(
+        index, out_path, query=query, queries=queries, n=n, combine=combine, remove_base64=remove_base64,
+        meta_filter=meta_filter, diversity=diversity,
+    )
+    if stats_path is not None:
+        index.metrics.write(stats_path)
 
 
 @recipe(
@@ -58,10 +148,17 @@ def image_fetch(source: Path, index_path: Path, out_path: Path, query: str, n: i
     source=("Examples that have been indexed", "positional", None, str),
     index_path=("Path to trained index", "positional", None, Path),
     labels=("Comma seperated labels to use", "option", "l", str),
-    query=("ANN query to run", "option", "q", str),
+    query=("ANN query to run, parts like 'jam; tray^0.5; -toner; @12' are combined", "option", "q", str),
     remove_base64=("Remove base64-encoded image data", "flag", "R", bool),
     n=("Number of results to return", "option", "n", int),
     allow_reset=("Allow the user to restart the query", "flag", "r", bool),
+    query_cache_size=("Number of queries to cache results for when resetting", "option", "qc", int),
+    ef=("HNSW candidate list size at query time, higher is more accurate but slower", "option", "ef", int),
+    meta_filter=("Only return examples whose meta matches, e.g. lang=de|en,source=crm", "option", "mf", str),
+    diversity=("Trade relevance for diversity from 0 to 1, to skip near-duplicates", "option", "dv", float),
+    model=("Model to check against the index, defaults to the one it was built with", "option", "m", str),
+    inference=("Inference for queries: torch or int8, defaults to the one the index used", "option", "inf", str),
+    stats_path=("Write timing and memory stats to this JSONL or Prometheus .prom file", "option", "sp", Path),
     # fmt: on
 )
 def image_ann_manual(
@@ -73,11 +170,31 @@ def image_ann_manual(
         remove_base64: bool = False,
         n: int = 100,
         allow_reset: bool = False,
+        query_cache_size: int = QUERY_CACHE_SIZE,
+        ef: Optional[int] = None,
+        meta_filter: Optional[str] = None,
+        diversity: float = 0.0,
+        model: Optional[str] = None,
+        inference: Optional[str] = None,
+        stats_path: Optional[Path] = None,
 ):
     """Run image.manual using a query to populate the stream."""
-    index = ApproximateIndex(model_name='clip-ViT-B-32', source=source, index_path=index_path)
-    stream = index.new_stream(query, n=n)
+    # Prodigy imports every recipe module on startup, so the recipe we wrap is imported on use.
+    from prodigy.recipes.image import image_manual
+
+    index = ApproximateIndex(
+        model_name=model,
+        default_model=IMAGE_MODEL,
+        source=source,
+        index_path=index_path,
+        query_cache_size=query_cache_size,
+        ef=ef,
+        inference=inference,
+    )
+    stream = index.new_stream(query, n=n, meta_filter=meta_filter, diversity=diversity)
     components = image_manual(dataset, source=stream, loader="images", label=labels.split(","), remove_base64=remove_base64)
+    components = exclude_annotated(components, index, dataset)
+    components = write_stats_on_exit(components, index, stats_path)
     # Only update the components if the user wants to allow the user to reset the stream
     if allow_reset:
         blocks = [
@@ -85,7 +202,9 @@ def image_ann_manual(
             {"view_id": "html", "html_template": HTML}
         ]
         components["event_hooks"] = {
-            "stream-reset": stream_reset_calback(index, n)
+            "stream-reset": stream_reset_calback(
+                index, n, meta_filter=meta_filter, diversity=diversity, stats_path=stats_path
+            )
         }
         components["view_id"] = "blocks"
         components["config"]["javascript"] = JS
@@ -0,0 +1,138 @@
+import os
+import re
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import srsly
+
+# Keep identifiers like product codes and error strings in one piece, e.g. "x1-200.5" or "e_404".
+TOKEN_RE = re.compile(r"\w+(?:[-./]\w+)*")
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Rank constant of reciprocal rank fusion, 60 is the value from the original paper.
+RRF_K = 60
+POSTING_DTYPE = np.dtype([("label", "<u4"), ("tf", "<u2")])
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def lexical_paths(index_path: Path) -> Dict[str, Path]:
+    return {
+        "vocab": Path(f"{index_path}.lexical.json"),
+        "offsets": Path(f"{index_path}.lexical-offsets.npy"),
+        "postings": Path(f"{index_path}.lexical-postings.npy"),
+        "lengths": Path(f"{index_path}.lexical-lengths.npy"),
+    }
+
+
+class LexicalIndex:
+    """BM25 index over the texts of an index, with postings stored as compact arrays.
+
+    Postings of all tokens are concatenated in one array of `(label, tf)` records sorted by
+    token, `offsets` marks where the postings of every token start. Scoring a query gathers
+    the postings of its tokens and sums their scores per label with numpy.
+    """
+
+    def __init__(self):
+        self.vocab: Dict[str, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=POSTING_DTYPE)
+        self.lengths = np.empty(0, dtype=np.uint32)
+        self.avg_length = 1.0
+        self._tokens, self._labels, self._tfs, self._lengths = array("I"), array("I"), array("H"), array("I")
+
+    @classmethod
+    def load(cls, index_path: Path) -> Optional["LexicalIndex"]:
+        paths = lexical_paths(index_path)
+        if not paths["vocab"].exists():
+            return None
+        lexical = cls()
+        vocab = srsly.read_json(paths["vocab"])["vocab"]
+        lexical.vocab = {token: i for i, token in enumerate(vocab)}
+        lexical.offsets = np.load(paths["offsets"])
+        lexical.postings = np.load(paths["postings"], mmap_mode="r")
+        lexical.lengths = np.load(paths["lengths"], mmap_mode="r")
+        lexical.avg_length = max(float(lexical.lengths.mean()), 1.0) if len(lexical.lengths) else 1.0
+        return lexical
+
+    def __len__(self) -> int:
+        return len(self.lengths) + len(self._lengths)
+
+    def add(self, label: int, text: str) -> None:
+        if label != len(self):
+            raise ValueError(f"Labels need to be added in order, expected {len(self)} but got {label}.")
+        tokens = tokenize(text)
+        for token, count in Counter(tokens).items():
+            self._tokens.append(self.vocab.setdefault(token, len(self.vocab)))
+            self._labels.append(label)
+            self._tfs.append(min(count, 65535))
+        self._lengths.append(len(tokens))
+
+    def _consolidate(self) -> None:
+        if not len(self._lengths):
+            return
+        # Existing postings are sorted by token already, a stable sort keeps labels in order.
+        old_tokens = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.uint32), np.diff(self.offsets))
+        tokens = np.concatenate([old_tokens, np.frombuffer(self._tokens, dtype=np.uint32)])
+        new = np.empty(len(self._labels), dtype=POSTING_DTYPE)
+        new["label"] = np.frombuffer(self._labels, dtype=np.uint32)
+        new["tf"] = np.frombuffer(self._tfs, dtype=np.uint16)
+        order = np.argsort(tokens, kind="stable")
+        self.postings = np.concatenate([self.postings, new])[order]
+        self.offsets = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tokens, minlength=len(self.vocab)), out=self.offsets[1:])
+        self.lengths = np.concatenate([self.lengths, np.frombuffer(self._lengths, dtype=np.uint32)])
+        self.avg_length = max(float(self.lengths.mean()), 1.0)
+        self._tokens, self._labels, self._tfs, self._lengths = array("I"), array("I"), array("H"), array("I")
+
+    def search(self, query: str, k: int, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Labels and BM25 scores of the `k` best matching texts, best first."""
+        self._consolidate()
+        token_ids = [self.vocab[token] for token in set(tokenize(query)) if token in self.vocab]
+        if not token_ids or not len(self.lengths):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        parts = [self.postings[self.offsets[i]:self.offsets[i + 1]] for i in token_ids]
+        dfs = np.array([len(part) for part in parts])
+        idf = np.log1p((len(self.lengths) - dfs + 0.5) / (dfs + 0.5))
+        labels = np.concatenate([part["label"] for part in parts]).astype(np.int64)
+        tfs = np.concatenate([part["tf"] for part in parts]).astype(np.float32)
+        lengths = self.lengths[labels] / self.avg_length
+        scores = np.repeat(idf, dfs) * tfs * (BM25_K1 + 1) / (tfs + BM25_K1 * (1 - BM25_B + BM25_B * lengths))
+        if allowed is not None:
+            keep = np.isin(labels, allowed)
+            labels, scores = labels[keep], scores[keep]
+        labels, inverse = np.unique(labels, return_inverse=True)
+        totals = np.bincount(inverse, weights=scores)
+        if len(totals) > k:
+            top = np.argpartition(-totals, k - 1)[:k]
+            labels, totals = labels[top], totals[top]
+        order = np.argsort(-totals, kind="stable")
+        return labels[order], totals[order].astype(np.float32)
+
+    def save(self, index_path: Path) -> None:
+        self._consolidate()
+        paths = lexical_paths(index_path)
+        vocab = sorted(self.vocab, key=self.vocab.get)
+        srsly.write_json(paths["vocab"], {"vocab": vocab})
+        for name in ("offsets", "postings", "lengths"):
+            # Loaded arrays may be mapped from the files we're writing, so replace them instead.
+            tmp_path = paths[name].with_name(f"{paths[name].name}.tmp")
+            with tmp_path.open("wb") as f:
+                np.save(f, np.ascontiguousarray(getattr(self, name)))
+            os.replace(tmp_path, paths[name])
+
+
+def reciprocal_rank_fusion(rankings: List[np.ndarray], k: int) -> np.ndarray:
+    """Fuse ranked lists of labels, every list contributes `1 / (RRF_K + rank)` to a label."""
+    labels = np.concatenate(rankings).astype(np.int64)
+    if not len(labels):
+        return labels
+    scores = np.concatenate([1.0 / (RRF_K + np.arange(1, len(ranking) + 1)) for ranking in rankings])
+    labels, inverse = np.unique(labels, return_inverse=True)
+    totals = np.bincount(inverse, weights=scores)
+    return labels[np.argsort(-totals, kind="stable")[:k]]
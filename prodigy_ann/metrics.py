@@ -0,0 +1,126 @@
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional
+
+import srsly
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROMETHEUS_PREFIX = "prodigy_ann"
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident memory of the process in bytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def current_rss() -> Optional[int]:
+    """Current resident memory of the process in bytes, only known on Linux."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class Metrics:
+    """Time spent per stage, e.g. encoding or searching, with how much it grew peak memory.
+
+    Every stage counts its calls, items, total and slowest time. Recording a stage costs a
+    couple of timer reads and a lock, so it's cheap enough to keep on in production.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float, items: int = 1, peak_growth: int = 0) -> None:
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = {"calls": 0, "items": 0, "seconds": 0.0, "max_seconds": 0.0, "peak_rss_growth": 0}
+                self.stages[stage] = stats
+            stats["calls"] += 1
+            stats["items"] += items
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["peak_rss_growth"] += peak_growth
+
+    @contextmanager
+    def timer(self, stage: str, items: int = 1):
+        peak = peak_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            growth = peak_rss() - peak if peak is not None else 0
+            self.add(stage, seconds, items, growth)
+
+    def timed(self, examples: Iterable, stage: str) -> Iterator:
+        """Yield from an iterable, counting the time spent getting the items as a stage."""
+        examples = iter(examples)
+        while True:
+            start = time.perf_counter()
+            try:
+                ex = next(examples)
+            except StopIteration:
+                return
+            self.add(stage, time.perf_counter() - start)
+            yield ex
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            stages = {stage: dict(stats) for stage, stats in self.stages.items()}
+        for stats in stages.values():
+            stats["mean_ms"] = stats["seconds"] / stats["calls"] * 1000
+        return {
+            "uptime_seconds": time.time() - self.started,
+            "rss": current_rss(),
+            "peak_rss": peak_rss(),
+            "stages": stages,
+        }
+
+    def write(self, path: Path) -> None:
+        """Append the stats to a JSONL file, or replace a Prometheus text file ending in `.prom`."""
+        path = Path(path)
+        stats = self.as_dict()
+        if path.suffix == ".prom":
+            tmp_path = path.with_name(f"{path.name}.tmp")
+            tmp_path.write_text(to_prometheus(stats), encoding="utf8")
+            # Scrapers may read the file at any time, so it's replaced in one go.
+            os.replace(tmp_path, path)
+        else:
+            srsly.write_jsonl(path, [{"time": time.time(), **stats}], append=True, append_new_line=False)
+
+
+def to_prometheus(stats: Dict) -> str:
+    """Stats in the Prometheus text format, e.g. for node_exporter's textfile collector."""
+    lines = []
+    for name, key, kind in [
+        ("stage_calls_total", "calls", "counter"),
+        ("stage_items_total", "items", "counter"),
+        ("stage_seconds_total", "seconds", "counter"),
+        ("stage_max_seconds", "max_seconds", "gauge"),
+        ("stage_peak_rss_growth_bytes", "peak_rss_growth", "counter"),
+    ]:
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+        for stage, values in sorted(stats["stages"].items()):
+            lines.append(f'{PROMETHEUS_PREFIX}_{name}{{stage="{stage}"}} {values[key]}')
+    for name, key in [("rss_bytes", "rss"), ("peak_rss_bytes", "peak_rss"), ("uptime_seconds", "uptime_seconds")]:
+        if stats[key] is not None:
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge")
+            lines.append(f"{PROMETHEUS_PREFIX}_{name} {stats[key]}")
+    return "\n".join(lines) + "\n"
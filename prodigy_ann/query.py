@@ -0,0 +1,57 @@
+import re
+from typing import List, NamedTuple, Optional
+
+WEIGHT_RE = re.compile(r"^(.*?)\s*(?<!\\)\^\s*(\d+(?:\.\d+)?)$")
+SEPARATOR_RE = re.compile(r"(?<!\\);")
+ESCAPED_RE = re.compile(r"\\([;@^\\-])")
+
+
+class QueryPart(NamedTuple):
+    text: Optional[str]
+    label: Optional[int]
+    weight: float = 1.0
+    negative: bool = False
+
+
+def parse_query(query: str) -> List[QueryPart]:
+    r"""Parse a query like `printer jam; paper tray^0.5; -toner; @1234` into weighted parts.
+
+    Parts are separated by `;`. A leading `-` makes a part negative, `^` sets its weight and
+    `@` refers to an example in the index by its label, so its stored vector is used. A
+    backslash keeps any of these characters as text, e.g. `C\;` or `\-v`.
+    """
+    parts = []
+    for raw in SEPARATOR_RE.split(query):
+        raw = raw.strip()
+        negative = raw.startswith("-")
+        raw = raw[1:].strip() if negative else raw
+        weight = 1.0
+        match = WEIGHT_RE.match(raw)
+        if match:
+            raw, weight = match.group(1), float(match.group(2))
+        if not raw:
+            continue
+        if raw.startswith("@") and raw[1:].isdigit():
+            parts.append(QueryPart(None, int(raw[1:]), weight, negative))
+        else:
+            parts.append(QueryPart(raw, None, weight, negative))
+    return parts
+
+
+def is_multi_query(query: str) -> bool:
+    r"""Whether a query uses the multi-part syntax, everything else is searched as a single text.
+
+    That takes a part that isn't negative, and either a second one or an `@label`, a `^weight`
+    or a negative part. Text that starts with `-` is still a plain query, a literal `;` can
+    be escaped as `\;`.
+    """
+    parts = parse_query(query)
+    positive = [part for part in parts if not part.negative]
+    if not positive:
+        return False
+    return len(positive) > 1 or any(part.label is not None or part.negative or part.weight != 1.0 for part in parts)
+
+
+def unescape(text: str) -> str:
+    """The text to encode for a query or part, without the backslashes that escape the syntax."""
+    return ESCAPED_RE.sub(r"\1", text)
@@ -0,0 +1,87 @@
+import mmap
+import os
+import shutil
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+import srsly
+
+
+def store_paths(index_path: Path):
+    """Paths of the packed example records and their offsets for an index."""
+    return Path(f"{index_path}.examples.jsonl"), Path(f"{index_path}.offsets.npy")
+
+
+def store_exists(index_path: Path) -> bool:
+    return all(p.exists() for p in store_paths(index_path))
+
+
+class ExampleStore:
+    """Read-only, memory-mapped store of examples where record `i` belongs to index label `i`.
+
+    Only the offsets array and the pages of the records that are accessed end up in memory,
+    so looking up examples doesn't require the source to be loaded.
+    """
+
+    def __init__(self, index_path: Path):
+        self.index_path = Path(index_path)
+        self.records_path, self.offsets_path = store_paths(index_path)
+        self.offsets = np.load(self.offsets_path, mmap_mode="r")
+        self._file = self.records_path.open("rb")
+        if self.records_path.stat().st_size > 0:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._data = b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, label: int) -> Dict:
+        start, end = int(self.offsets[label]), int(self.offsets[label + 1])
+        return srsly.json_loads(self._data[start:end].decode("utf8"))
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+
+class ExampleStoreWriter:
+    """Writes examples in label order, either to a new store or appending to an existing one."""
+
+    def __init__(self, index_path: Path, append: bool = False):
+        self.records_path, self.offsets_path = store_paths(index_path)
+        if append and store_exists(index_path):
+            self.base_offsets = np.load(self.offsets_path)
+            self._file = self.records_path.open("r+b")
+            # Drop anything that was written after the last complete record.
+            self._file.truncate(int(self.base_offsets[-1]))
+            self._file.seek(int(self.base_offsets[-1]))
+        else:
+            self.base_offsets = np.zeros(1, dtype=np.uint64)
+            self._file = self.records_path.open("wb")
+        self.position = int(self.base_offsets[-1])
+        self.new_offsets = []
+
+    def add(self, example: Dict) -> None:
+        record = (srsly.json_dumps(example) + "\n").encode("utf8")
+        self._file.write(record)
+        self.position += len(record)
+        self.new_offsets.append(self.position)
+
+    def __len__(self) -> int:
+        return len(self.base_offsets) - 1 + len(self.new_offsets)
+
+    def close(self) -> None:
+        self._file.close()
+        offsets = np.concatenate([self.base_offsets, np.array(self.new_offsets, dtype=np.uint64)])
+        # Replace rather than overwrite, the old offsets may still be memory-mapped by a reader.
+        tmp_path = self.offsets_path.with_name(self.offsets_path.name + ".tmp.npy")
+        np.save(tmp_path, offsets.astype(np.uint64))
+        os.replace(tmp_path, self.offsets_path)
+
+
+def copy_store(src_index_path: Path, dst_index_path: Path) -> None:
+    for src, dst in zip(store_paths(src_index_path), store_paths(dst_index_path)):
+        shutil.copyfile(src, dst)
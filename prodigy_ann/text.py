@@ -1,15 +1,19 @@
 from pathlib import Path
 from typing import Optional
 
+import numpy as np
 import srsly
-import spacy
 
 from prodigy import recipe
-from prodigy.util import log
-from prodigy.recipes.textcat import manual as textcat_manual
-from prodigy.recipes.ner import manual as ner_manual
-from prodigy.recipes.spans import manual as spans_manual
-from prodigy_ann.util import ApproximateIndex, stream_reset_calback, HTML, JS, CSS
+from prodigy.util import log, msg
+from prodigy_ann.util import ApproximateIndex, stream_reset_calback, write_fetched, read_queries
+from prodigy_ann.util import exclude_annotated, passage_stream, write_stats_on_exit
+from prodigy_ann.util import HTML, JS, CSS, QUERY_CACHE_SIZE, BATCH_SIZE, cache_key
+from prodigy_ann.benchmark import benchmark_hnsw
+from prodigy_ann.cache import EmbeddingCache
+from prodigy_ann.bundle import index_exists
+
+TEXT_MODEL = "all-MiniLM-L6-v2"
 
 
 @recipe(
@@ -17,13 +21,74 @@ from prodigy_ann.util import ApproximateIndex, stream_reset_calback, HTML, JS, C
     # fmt: off
     source=("Path to text source to index", "positional", None, str),
     index_path=("Path of trained index", "positional", None, Path),
+    cache_path=("Path to an embedding cache to reuse between runs", "option", "c", Path),
+    cache_size=("Maximum number of embeddings to keep in the cache", "option", "cs", int),
+    model=("Sentence-transformers model to encode examples with, defaults to all-MiniLM-L6-v2", "option", "m", str),
+    batch_size=("Number of examples to encode per batch", "option", "bs", int),
+    inference=("Inference to use: torch, or int8 for faster quantized CPU inference", "option", "inf", str),
+    update=("Only add new examples to an existing index", "flag", "u", bool),
+    workers=("Number of processes to encode examples with", "option", "w", int),
+    shards=("Shards to build one by one, searching loads all hnsw shards, exact ones are mapped", "option", "s", int),
+    hnsw_m=("HNSW number of links per element", "option", "M", int),
+    ef_construction=("HNSW candidate list size while building", "option", "efc", int),
+    ef=("HNSW candidate list size at query time, higher is more accurate but slower", "option", "ef", int),
+    backend=("Search backend: auto (exact for small indexes), hnsw or exact", "option", "b", str),
+    quantize=("Store vectors as float16 or int8 to save memory, uses the exact backend", "option", "qt", str),
+    rerank=("Keep full-precision vectors on disk to re-rank quantized results", "flag", "rr", bool),
+    filter_fields=("Comma separated meta fields to build filters for", "option", "ff", str),
+    lexical=("Also build a BM25 index, so queries combine lexical and semantic matches", "flag", "lx", bool),
+    dedup_threshold=("Show one of every group of near-duplicates within this distance", "option", "dd", float),
+    chunk_words=("Split texts into chunks of this many words, to find passages in long texts", "option", "cw", int),
+    stats_path=("Write timing and memory stats to this JSONL or Prometheus .prom file", "option", "sp", Path),
     # fmt: on
 )
-def text_index(source: Path, index_path: Path):
+def text_index(
+    source: Path,
+    index_path: Path,
+    cache_path: Optional[Path] = None,
+    cache_size: Optional[int] = None,
+    model: Optional[str] = None,
+    batch_size: int = BATCH_SIZE,
+    inference: Optional[str] = None,
+    update: bool = False,
+    workers: int = 1,
+    shards: int = 1,
+    hnsw_m: Optional[int] = None,
+    ef_construction: Optional[int] = None,
+    ef: Optional[int] = None,
+    backend: Optional[str] = None,
+    quantize: Optional[str] = None,
+    rerank: bool = False,
+    filter_fields: Optional[str] = None,
+    lexical: bool = False,
+    dedup_threshold: Optional[float] = None,
+    chunk_words: Optional[int] = None,
+    stats_path: Optional[Path] = None,
+):
     """Builds an HSNWLIB index on example text data."""
     log("RECIPE: Calling `ann.text.index`")
-    index = ApproximateIndex(model_name='all-MiniLM-L6-v2', source=source)
-    index.build_index().store_index(index_path)
+    settings = dict(
+        hnsw_m=hnsw_m, ef_construction=ef_construction, ef=ef, backend=backend, quantize=quantize, rerank=rerank,
+        filter_fields=filter_fields.split(",") if filter_fields else None, lexical=lexical,
+        dedup_threshold=dedup_threshold, inference=inference, chunk_words=chunk_words,
+    )
+    if update and index_exists(index_path):
+        # Updates keep using the model the index was built with.
+        index = ApproximateIndex(
+            model_name=model, source=source, index_path=index_path, default_model=TEXT_MODEL, check_source=False,
+            **settings,
+        )
+        cache = EmbeddingCache(cache_path, cache_key(index), max_items=cache_size) if cache_path else None
+        index.update_index(cache=cache, workers=workers, batch_size=batch_size)
+    else:
+        index = ApproximateIndex(model_name=model or TEXT_MODEL, source=source, **settings)
+        cache = EmbeddingCache(cache_path, cache_key(index), max_items=cache_size) if cache_path else None
+        index.build_index(cache=cache, workers=workers, shards=shards, batch_size=batch_size)
+    index.store_index(index_path)
+    if stats_path is not None:
+        index.metrics.write(stats_path)
+    if cache is not None:
+        cache.close()
 
 
 @recipe(
@@ -34,17 +99,101 @@ def text_index(source: Path, index_path: Path):
     out_path=("Path to write examples into", "positional", None, Path),
     query=("ANN query to run", "option", "q", str),
     n=("Number of results to return", "option", "n", int),
+    queries=("File with one query per line to run in a single batch", "option", "qs", Path),
+    combine=("Write deduplicated results for all queries into a single file", "flag", "C", bool),
+    ef=("HNSW candidate list size at query time, higher is more accurate but slower", "option", "ef", int),
+    backend=("Search backend to use instead of the one the index was built with", "option", "b", str),
+    meta_filter=("Only return examples whose meta matches, e.g. lang=de|en,source=crm", "option", "mf", str),
+    diversity=("Trade relevance for diversity from 0 to 1, to skip near-duplicates", "option", "dv", float),
+    model=("Model to check against the index, defaults to the one it was built with", "option", "m", str),
+    inference=("Inference for queries: torch or int8, defaults to the one the index used", "option", "inf", str),
+    stats_path=("Write timing and memory stats to this JSONL or Prometheus .prom file", "option", "sp", Path),
     # fmt: on
 )
-def text_fetch(source: Path, index_path: Path, out_path: Path, query:str, n:int=200):
+def text_fetch(
+    source: Path,
+    index_path: Path,
+    out_path: Path,
+    query: Optional[str] = None,
+    n: int = 200,
+    queries: Optional[Path] = None,
+    combine: bool = False,
+    ef: Optional[int] = None,
+    backend: Optional[str] = None,
+    meta_filter: Optional[str] = None,
+    diversity: float = 0.0,
+    model: Optional[str] = None,
+    inference: Optional[str] = None,
+    stats_path: Optional[Path] = None,
+):
     """Fetch a relevant subset using a HNSWlib index."""
     log("RECIPE: Calling `ann.text.fetch`")
-    if not query:
-        raise ValueError("must pass query")
+    if not query and not queries:
+        raise ValueError("must pass query or queries")
+
+    index = ApproximateIndex(
+        model_name=model, source=source, index_path=index_path, ef=ef, backend=backend, inference=inference,
+        default_model=TEXT_MODEL,
+    )
+    write_fetched(
+        index, out_path, query=query, queries=queries, n=n, combine=combine, meta_filter=meta_filter,
+        diversity=diversity,
+    )
+    if stats_path is not None:
+        index.metrics.write(stats_path)
+
 
-    index = ApproximateIndex(model_name='all-MiniLM-L6-v2', source=source, index_path=index_path)
-    srsly.write_jsonl(out_path, index.new_stream(query, n=n))
-    log(f"RECIPE: New stream stored at {out_path}")
+@recipe(
+    "ann.text.benchmark",
+    # fmt: off
+    source=("Path to text source to benchmark on", "positional", None, str),
+    k=("Number of neighbours to measure recall for", "option", "k", int),
+    n_queries=("Number of examples to sample as queries", "option", "nq", int),
+    queries=("File with queries to use instead of sampled examples", "option", "qs", Path),
+    hnsw_m=("Comma separated values of M to try", "option", "M", str),
+    ef_construction=("Comma separated values of ef_construction to try", "option", "efc", str),
+    ef=("Comma separated values of ef to try", "option", "ef", str),
+    model=("Sentence-transformers model to encode examples with, defaults to all-MiniLM-L6-v2", "option", "m", str),
+    batch_size=("Number of examples to encode per batch", "option", "bs", int),
+    output=("Path to write the results to as JSON", "option", "o", Path),
+    # fmt: on
+)
+def text_benchmark(
+    source: Path,
+    k: int = 10,
+    n_queries: int = 200,
+    queries: Optional[Path] = None,
+    hnsw_m: str = "16",
+    ef_construction: str = "200",
+    ef: str = "10,50,100,200",
+    model: Optional[str] = None,
+    batch_size: int = BATCH_SIZE,
+    output: Optional[Path] = None,
+):
+    """Measure build time, query latency and recall@k of HNSW settings against brute force."""
+    log("RECIPE: Calling `ann.text.benchmark`")
+    index = ApproximateIndex(model_name=model or TEXT_MODEL, source=source)
+    vectors = index.encode_source(batch_size=batch_size)
+    if queries:
+        query_vectors = index.encode_queries(read_queries(queries))
+    else:
+        rng = np.random.default_rng(0)
+        query_vectors = vectors[rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)]
+    results = benchmark_hnsw(
+        vectors,
+        query_vectors,
+        k=k,
+        hnsw_ms=[int(v) for v in hnsw_m.split(",")],
+        ef_constructions=[int(v) for v in ef_construction.split(",")],
+        efs=[int(v) for v in ef.split(",")],
+        space=index.space,
+    )
+    header = list(results[0].keys())
+    rows = [[round(v, 4) if isinstance(v, float) else v for v in r.values()] for r in results]
+    msg.table(rows, header=header, divider=True)
+    if output:
+        srsly.write_json(output, results)
+        log(f"RECIPE: Benchmark results stored at {output}")
 
 
 @recipe(
@@ -54,10 +203,17 @@ def text_fetch(source: Path, index_path: Path, out_path: Path, query:str, n:int=
     examples=("Examples that have been indexed", "positional", None, str),
     index_path=("Path to trained index", "positional", None, Path),
     labels=("Comma seperated labels to use", "option", "l", str),
-    query=("ANN query to run", "option", "q", str),
+    query=("ANN query to run, parts like 'jam; tray^0.5; -toner; @12' are combined", "option", "q", str),
     exclusive=("Labels are exclusive", "flag", "e", bool),
     n=("Number of items to retreive via query", "option", "n", int),
-    allow_reset=("Allow the user to restart the query", "flag", "r", bool)
+    allow_reset=("Allow the user to restart the query", "flag", "r", bool),
+    query_cache_size=("Number of queries to cache results for when resetting", "option", "qc", int),
+    ef=("HNSW candidate list size at query time, higher is more accurate but slower", "option", "ef", int),
+    meta_filter=("Only return examples whose meta matches, e.g. lang=de|en,source=crm", "option", "mf", str),
+    diversity=("Trade relevance for diversity from 0 to 1, to skip near-duplicates", "option", "dv", float),
+    model=("Model to check against the index, defaults to the one it was built with", "option", "m", str),
+    inference=("Inference for queries: torch or int8, defaults to the one the index used", "option", "inf", str),
+    stats_path=("Write timing and memory stats to this JSONL or Prometheus .prom file", "option", "sp", Path),
     # fmt: on
 )
 def textcat_ann_manual(
@@ -68,13 +224,33 @@ def textcat_ann_manual(
     query:str,
     exclusive:bool = False,
     n:int = 200,
-    allow_reset: bool = False
+    allow_reset: bool = False,
+    query_cache_size: int = QUERY_CACHE_SIZE,
+    ef: Optional[int] = None,
+    meta_filter: Optional[str] = None,
+    diversity: float = 0.0,
+    model: Optional[str] = None,
+    inference: Optional[str] = None,
+    stats_path: Optional[Path] = None,
 ):
     """Run textcat.manual using a query to populate the stream."""
     log("RECIPE: Calling `textcat.ann.manual`")
-    index = ApproximateIndex(model_name='all-MiniLM-L6-v2', source=examples, index_path=index_path)
-    stream = index.new_stream(query, n=n)
+    # Prodigy imports every recipe module on startup, so the recipes we wrap are imported on use.
+    from prodigy.recipes.textcat import manual as textcat_manual
+
+    index = ApproximateIndex(
+        model_name=model,
+        default_model=TEXT_MODEL,
+        source=examples,
+        index_path=index_path,
+        query_cache_size=query_cache_size,
+        ef=ef,
+        inference=inference,
+    )
+    stream = index.new_stream(query, n=n, meta_filter=meta_filter, diversity=diversity)
     components = textcat_manual(dataset, stream, label=labels.split(","), exclusive=exclusive)
+    components = exclude_annotated(components, index, dataset)
+    components = write_stats_on_exit(components, index, stats_path)
     
     # Only update the components if the user wants to allow the user to reset the stream
     if allow_reset:
@@ -83,7 +259,9 @@ def textcat_ann_manual(
             {"view_id": "html", "html_template": HTML}
         ]
         components["event_hooks"] = {
-            "stream-reset": stream_reset_calback(index, n=n)
+            "stream-reset": stream_reset_calback(
+                index, n=n, meta_filter=meta_filter, diversity=diversity, stats_path=stats_path
+            )
         }
         components["view_id"] = "blocks"
         components["config"]["javascript"] = JS
@@ -100,9 +278,17 @@ def textcat_ann_manual(
     examples=("Examples that have been indexed", "positional", None, str),
     index_path=("Path to trained index", "positional", None, Path),
     labels=("Comma seperated labels to use", "option", "l", str),
-    query=("ANN query to run", "option", "q", str),
+    query=("ANN query to run, parts like 'jam; tray^0.5; -toner; @12' are combined", "option", "q", str),
     n=("Number of items to retreive via query", "option", "n", int),
-    allow_reset=("Allow the user to restart the query", "flag", "r", bool)
+    allow_reset=("Allow the user to restart the query", "flag", "r", bool),
+    query_cache_size=("Number of queries to cache results for when resetting", "option", "qc", int),
+    ef=("HNSW candidate list size at query time, higher is more accurate but slower", "option", "ef", int),
+    meta_filter=("Only return examples whose meta matches, e.g. lang=de|en,source=crm", "option", "mf", str),
+    diversity=("Trade relevance for diversity from 0 to 1, to skip near-duplicates", "option", "dv", float),
+    model=("Model to check against the index, defaults to the one it was built with", "option", "m", str),
+    inference=("Inference for queries: torch or int8, defaults to the one the index used", "option", "inf", str),
+    stats_path=("Write timing and memory stats to this JSONL or Prometheus .prom file", "option", "sp", Path),
+    passages=("Only show the passage that matched, for indexes of chunked texts", "flag", "ps", bool),
     # fmt: on
 )
 def ner_ann_manual(
@@ -114,25 +300,51 @@ def ner_ann_manual(
     query:str,
     n:int = 200,
     allow_reset:bool = False,
+    query_cache_size: int = QUERY_CACHE_SIZE,
+    ef: Optional[int] = None,
+    meta_filter: Optional[str] = None,
+    diversity: float = 0.0,
+    model: Optional[str] = None,
+    inference: Optional[str] = None,
+    stats_path: Optional[Path] = None,
+    passages: bool = False,
 ):
     """Run ner.manual using a query to populate the stream."""
     log("RECIPE: Calling `ner.ann.manual`")
+    # spaCy can take seconds to import, it may pull in torch.
+    import spacy
+    from prodigy.recipes.ner import manual as ner_manual
+
     if "blank" in nlp:
         spacy_mod = spacy.blank(nlp.replace("blank:", ""))
     else:
         spacy_mod = spacy.load(nlp)
-    index = ApproximateIndex(model_name='all-MiniLM-L6-v2', source=examples, index_path=index_path)
-    stream = index.new_stream(query, n=n)
+    index = ApproximateIndex(
+        model_name=model,
+        default_model=TEXT_MODEL,
+        source=examples,
+        index_path=index_path,
+        query_cache_size=query_cache_size,
+        ef=ef,
+        inference=inference,
+    )
+    stream = index.new_stream(query, n=n, meta_filter=meta_filter, diversity=diversity)
+    if passages:
+        stream = passage_stream(stream)
     
     # Only update the components if the user wants to allow the user to reset the stream
     components = ner_manual(dataset, spacy_mod, stream, label=labels.split(","))
+    components = exclude_annotated(components, index, dataset)
+    components = write_stats_on_exit(components, index, stats_path)
     if allow_reset:
         blocks = [
             {"view_id": components["view_id"]}, 
             {"view_id": "html", "html_template": HTML}
         ]
         components["event_hooks"] = {
-            "stream-reset": stream_reset_calback(index, n=n)
+            "stream-reset": stream_reset_calback(
+                index, n=n, meta_filter=meta_filter, diversity=diversity, stats_path=stats_path, passages=passages
+            )
         }
         components["view_id"] = "blocks"
         components["config"]["javascript"] = JS
@@ -150,9 +362,17 @@ def ner_ann_manual(
     index_path=("Path to trained index", "positional", None, Path),
     labels=("Comma seperated labels to use", "option", "l", str),
     patterns=("Path to match patterns file", "option", "pt", Path),
-    query=("ANN query to run", "option", "q", str),
+    query=("ANN query to run, parts like 'jam; tray^0.5; -toner; @12' are combined", "option", "q", str),
     n=("Number of items to retreive via query", "option", "n", int),
-    allow_reset=("Allow the user to restart the query", "flag", "r", bool)
+    allow_reset=("Allow the user to restart the query", "flag", "r", bool),
+    query_cache_size=("Number of queries to cache results for when resetting", "option", "qc", int),
+    ef=("HNSW candidate list size at query time, higher is more accurate but slower", "option", "ef", int),
+    meta_filter=("Only return examples whose meta matches, e.g. lang=de|en,source=crm", "option", "mf", str),
+    diversity=("Trade relevance for diversity from 0 to 1, to skip near-duplicates", "option", "dv", float),
+    model=("Model to check against the index, defaults to the one it was built with", "option", "m", str),
+    inference=("Inference for queries: torch or int8, defaults to the one the index used", "option", "inf", str),
+    stats_path=("Write timing and memory stats to this JSONL or Prometheus .prom file", "option", "sp", Path),
+    passages=("Only show the passage that matched, for indexes of chunked texts", "flag", "ps", bool),
     # fmt: on
 )
 def spans_ann_manual(
@@ -164,26 +384,51 @@ def spans_ann_manual(
     query:str,
     patterns: Optional[Path] = None,
     n:int = 200,
-    allow_reset: bool = False
+    allow_reset: bool = False,
+    query_cache_size: int = QUERY_CACHE_SIZE,
+    ef: Optional[int] = None,
+    meta_filter: Optional[str] = None,
+    diversity: float = 0.0,
+    model: Optional[str] = None,
+    inference: Optional[str] = None,
+    stats_path: Optional[Path] = None,
+    passages: bool = False,
 ):
     """Run spans.manual using a query to populate the stream."""
     log("RECIPE: Calling `spans.ann.manual`")
+    import spacy
+    from prodigy.recipes.spans import manual as spans_manual
+
     if "blank" in nlp:
         spacy_mod = spacy.blank(nlp.replace("blank:", ""))
     else:
         spacy_mod = spacy.load(nlp)
-    index = ApproximateIndex(model_name='all-MiniLM-L6-v2', source=examples, index_path=index_path)
-    stream = index.new_stream(query, n=n)
+    index = ApproximateIndex(
+        model_name=model,
+        default_model=TEXT_MODEL,
+        source=examples,
+        index_path=index_path,
+        query_cache_size=query_cache_size,
+        ef=ef,
+        inference=inference,
+    )
+    stream = index.new_stream(query, n=n, meta_filter=meta_filter, diversity=diversity)
+    if passages:
+        stream = passage_stream(stream)
 
     # Only update the components if the user wants to allow the user to reset the stream
     components = spans_manual(dataset, spacy_mod, stream, label=labels.split(","), patterns=patterns)
+    components = exclude_annotated(components, index, dataset)
+    components = write_stats_on_exit(components, index, stats_path)
     if allow_reset:
         blocks = [
             {"view_id": components["view_id"]}, 
             {"view_id": "html", "html_template": HTML}
         ]
         components["event_hooks"] = {
-            "stream-reset": stream_reset_calback(index, n=n)
+            "stream-reset": stream_reset_calback(
+                index, n=n, meta_filter=meta_filter, diversity=diversity, stats_path=stats_path, passages=passages
+            )
         }
         components["view_id"] = "blocks"
         components["config"]["javascript"] = JS
@@ -0,0 +1,107 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from PIL import Image
+from prodigy.util import log
+
+# CLIP resizes the shortest side of an image to this size, any detail beyond it is thrown away.
+IMAGE_SIZE = 224
+
+
+def load_image(ex: Dict, size: int = IMAGE_SIZE, thumbnails: Optional["ThumbnailCache"] = None) -> Image.Image:
+    """Load the image of an example as RGB, reduced so its shortest side is `size`.
+
+    JPEGs are decoded at a reduced scale in draft mode, so large photos are never fully
+    decoded. The file is closed before returning, only the reduced copy stays in memory.
+    """
+    key = thumbnails.key(ex) if thumbnails is not None else None
+    if key is not None:
+        image = thumbnails.get(key)
+        if image is not None:
+            return image
+    with open_image(ex) as image:
+        image.draft("RGB", (size, size))
+        image = reduce_image(image.convert("RGB"), size)
+    if key is not None:
+        thumbnails.put(key, image)
+    return image
+
+
+def open_image(ex: Dict) -> Image.Image:
+    """Open the image at the `path` of an example, or decode its base64 `image` field."""
+    path = ex.get("path")
+    if path and Path(path).exists():
+        return Image.open(path)
+    data = ex.get("image")
+    if data and not data.startswith(("http://", "https://")):
+        # Data URIs look like `data:image/png;base64,...`.
+        _, _, data = data.rpartition(",")
+        return Image.open(io.BytesIO(base64.b64decode(data)))
+    raise ValueError(f"Can't load image for example, it needs a `path` or a base64 `image`: {ex.get('meta')}")
+
+
+def reduce_image(image: Image.Image, size: int = IMAGE_SIZE) -> Image.Image:
+    scale = size / min(image.size)
+    if scale >= 1:
+        return image
+    width, height = image.size
+    return image.resize((max(size, round(width * scale)), max(size, round(height * scale))), Image.BICUBIC)
+
+
+class ThumbnailCache:
+    """On-disk cache of reduced images, keyed by the path and modification time of the original.
+
+    Images from base64 `image` fields are keyed by their data. Thumbnails are stored as PNG,
+    so a cached image gives exactly the same embedding as a freshly reduced one.
+    """
+
+    def __init__(self, path: Path, size: int = IMAGE_SIZE):
+        self.path = Path(path)
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # Images are loaded by a pool of threads, `+=` on the counters isn't atomic.
+        self._lock = threading.Lock()
+        self.path.mkdir(parents=True, exist_ok=True)
+        log(f"CACHE: Using thumbnail cache at {self.path} with {size=}.")
+
+    def key(self, ex: Dict) -> Optional[str]:
+        path = ex.get("path")
+        if path and Path(path).exists():
+            stat = Path(path).stat()
+            source = f"{Path(path).resolve()}:{stat.st_mtime_ns}:{stat.st_size}".encode("utf8")
+        elif ex.get("image"):
+            source = ex["image"].encode("utf8")
+        else:
+            return None
+        digest = hashlib.blake2b(source, digest_size=16)
+        digest.update(f":{self.size}".encode("utf8"))
+        return digest.hexdigest()
+
+    def _file(self, key: str) -> Path:
+        # Spread the files over subfolders, some filesystems get slow with huge folders.
+        return self.path / key[:2] / f"{key}.png"
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        path = self._file(key)
+        if not path.exists():
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        with Image.open(path) as image:
+            return image.convert("RGB")
+
+    def put(self, key: str, image: Image.Image) -> None:
+        path = self._file(key)
+        path.parent.mkdir(exist_ok=True)
+        # Images are loaded by several threads, write to a temporary file and move it into place.
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)
@@ -1,16 +1,43 @@
 import itertools as it
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional, Literal
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Literal
 import textwrap
+import numpy as np
+import srsly
 from tqdm import tqdm
-from PIL import Image
-from sentence_transformers import SentenceTransformer
-from hnswlib import Index
 from prodigy.util import set_hashes
 from prodigy.util import log, msg
 from prodigy.components.stream import Stream
 from prodigy.components.stream import get_stream
+from prodigy.components.db import connect
 from prodigy.core import Controller
+from .backends import BACKENDS, EXACT_THRESHOLD, BackendName, LazyShard, Quantization, convert, normalize
+from .backends import maximal_marginal_relevance
+from .bundle import read_metadata, source_fingerprint, write_metadata
+from .cache import EmbeddingCache
+from .chunks import ChunkMap, chunk_spans
+from .clusters import find_clusters, load_clusters, save_clusters
+from .filters import MetaIndex, parse_filter
+from .lexical import LexicalIndex, reciprocal_rank_fusion
+from .metrics import Metrics
+from .models import Inference, load_model
+from .query import QueryPart, is_multi_query, parse_query, unescape
+from .store import ExampleStore, ExampleStoreWriter, copy_store, store_exists, store_paths
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+    from .thumbnails import ThumbnailCache
 
 HTML = """
 <link
@@ -24,8 +51,16 @@ HTML = """
     <summary id="reset">Reset stream?</summary>
     <div class="prodigy-content">
         <label class="label" for="query">New query for ANN:</label>
-        <input class="prodigy-text-input text-input" type="text" id="query" name="query" value="">
+        <input
+            class="prodigy-text-input text-input"
+            type="text"
+            id="query"
+            name="query"
+            value=""
+            placeholder="printer jam; paper tray^0.5; -toner; @1234"
+        >
         <br><br>
+        <button id="moreButton" onclick="addExample()">More like this</button>
         <button id="refreshButton" onclick="refreshData()">
             Refresh Stream
             <i
@@ -73,6 +108,12 @@ CSS = """
 """
 
 JS = """
+function addExample() {
+  const input = document.getElementById("query")
+  const part = `@${window.prodigy.content.meta.index}`
+  input.value = input.value.trim() ? `${input.value}; ${part}` : part
+}
+
 function refreshData() {
   document.querySelector('#loadingIcon').style.display = 'inline-block'
   event_data = {
@@ -92,6 +133,19 @@ function refreshData() {
 }
 """
 
+BATCH_SIZE = 256
+PREFETCH_WORKERS = 4
+QUERY_CACHE_SIZE = 128
+# Number of results to show while the rest of a new stream is searched in the background.
+FIRST_RESULTS = 10
+# Candidates per result that diverse streams pick from.
+MMR_CANDIDATES = 3
+# hnswlib's own defaults, note that it always uses at least `k` for `ef` when querying.
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF = 10
+
+
 def batched(iterable, n=56):
     "Batch data into tuples of length n. The last batch may be shorter."
     if n < 1:
@@ -101,75 +155,1107 @@ def batched(iterable, n=56):
         yield batch
 
 
-def add_hashes(examples):
+def prefetched(batches, fn, workers: int = PREFETCH_WORKERS):
+    """Apply `fn` to upcoming batches in a thread pool, yielding `(batch, fn(batch))` in order.
+
+    Keeps up to `workers` batches in flight, so loading the next batches overlaps with
+    whatever the caller does with the current one.
+    """
+    batches = iter(batches)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        window = deque((b, pool.submit(fn, b)) for b in it.islice(batches, workers))
+        while window:
+            batch, future = window.popleft()
+            window.extend((b, pool.submit(fn, b)) for b in it.islice(batches, 1))
+            yield batch, future.result()
+
+
+class LRUCache:
+    """Small thread-safe least recently used cache, `maxsize=0` disables it."""
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.data:
+                return None
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+
+
+def add_hashes(examples, metrics: Optional[Metrics] = None):
     for ex in examples:
-        yield set_hashes(ex)
+        start = time.perf_counter()
+        ex = set_hashes(ex)
+        if metrics is not None:
+            metrics.add("hash", time.perf_counter() - start)
+        yield ex
+
+def hashes_path(index_path: Path) -> Path:
+    """Path of the sidecar file that maps index labels to `_input_hash` values."""
+    return Path(f"{index_path}.hashes.npy")
+
+
+def cache_key(index: "ApproximateIndex") -> str:
+    """Name to cache embeddings under, quantized inference gives slightly different vectors."""
+    return index.model_name if index.inference == "torch" else f"{index.model_name}:{index.inference}"
+
 
 class ApproximateIndex:
-    def __init__(self, model_name:str, source: Path, index_path: Optional[Path] = None):
-        log(f"INDEX: Using {model_name=} and source={str(source)}.")
-        stream = get_stream(source)
+    def __init__(
+        self,
+        model_name: Optional[str],
+        source: Path,
+        index_path: Optional[Path] = None,
+        query_cache_size: int = QUERY_CACHE_SIZE,
+        hnsw_m: Optional[int] = None,
+        ef_construction: Optional[int] = None,
+        ef: Optional[int] = None,
+        backend: Optional[BackendName] = None,
+        quantize: Optional[Quantization] = None,
+        rerank: bool = False,
+        filter_fields: Optional[List[str]] = None,
+        lexical: bool = False,
+        dedup_threshold: Optional[float] = None,
+        inference: Optional[Inference] = None,
+        chunk_words: Optional[int] = None,
+        default_model: Optional[str] = None,
+        check_source: bool = True,
+    ):
+        self.source = source
+        self.index_path = index_path
+        self._model = None
+        self._pool = None
+        # Time and memory per stage, to tell whether e.g. a slow reset is the model or the search.
+        self.metrics = Metrics()
+        # Annotators tend to go back and forth between the same queries when resetting the stream.
+        self.query_embeddings = LRUCache(query_cache_size)
+        self.query_results = LRUCache(query_cache_size)
+        # Input hashes of examples that new streams should skip, e.g. because they're annotated.
+        self.excluded = set()
 
-        # Always add the hashes at the end to prevent warning.
-        stream.apply(add_hashes)
-        
-        # Setup model and put everything in memory
-        self.model = SentenceTransformer(model_name)
-        self.examples = list(stream)
-        out = self.model.encode(["Test text right here."])
-        self.index = Index(space="cosine", dim=out.shape[1])
+        # An index bundle knows its own model and dimensions, so we only need the model once we encode.
+        self.meta = read_metadata(index_path) if index_path else None
+        self.model_name = self._check_model(model_name, default_model)
+        # Quantized inference gives slightly different vectors, so it can differ from the build.
+        self.inference = inference or (self.meta.get("inference") if self.meta else None) or "torch"
+        log(f"INDEX: Using model_name={self.model_name}, inference={self.inference} and source={str(source)}.")
+        if self.meta is not None:
+            # Updates are how a changed source gets indexed, so there's nothing to warn about.
+            if check_source:
+                self._check_source()
+            self.space, self.dim = self.meta["space"], self.meta["dim"]
+        else:
+            out = self.model.encode(["Test text right here."])
+            self.space, self.dim = "cosine", out.shape[1]
+
+        # Settings passed in take precedence over the ones the index was built with.
+        hnsw = self.meta.get("hnsw", {}) if self.meta else {}
+        self.hnsw_m = hnsw_m or hnsw.get("M", HNSW_M)
+        self.ef_construction = ef_construction or hnsw.get("ef_construction", HNSW_EF_CONSTRUCTION)
+        self.ef = ef or hnsw.get("ef", HNSW_EF)
+
+        # Small indexes are searched exactly, "auto" switches to hnswlib once the index grows.
+        loaded_backend = self.meta.get("backend", "hnsw") if self.meta else "hnsw"
+        # An "auto" index is stored with the backend it uses so far, but keeps switching as it grows.
+        built_mode = (self.meta.get("backend_mode") if self.meta else None) or loaded_backend
+        self.backend = backend or (built_mode if index_path else "auto")
+        if self.backend not in ("auto", *BACKENDS):
+            raise ValueError(f"Unknown backend {self.backend}, use one of: auto, {', '.join(BACKENDS)}.")
+
+        # Quantized vectors are only kept by the exact backend, hnswlib always stores float32.
+        self.quantize = quantize or (self.meta.get("quantize") if self.meta else None)
+        self.rerank = rerank or bool(self.meta and self.meta.get("rerank"))
+        if self.quantize and self.backend == "hnsw":
+            raise ValueError("Quantized vectors are only supported by the exact backend.")
+
+        # Long texts can be split into chunks of up to `chunk_words` words, then every label in the
+        # index is a chunk and the store holds the documents they belong to.
+        built_chunks = self.meta.get("chunk_words") if self.meta else None
+        self.chunk_words = chunk_words or built_chunks
+        if self.meta is not None and (self.chunk_words is None) != (built_chunks is None):
+            raise ValueError(
+                f"The index at {index_path} was built {'with' if built_chunks else 'without'} chunks, "
+                "rebuild it to change that."
+            )
+        self.chunks = None
+        if self.chunk_words:
+            self.chunks = (ChunkMap.load(index_path) if index_path else None) or ChunkMap()
+
+        # Large indexes can be split into shards, each holding a contiguous range of labels.
+        self.shard_size = self.meta.get("shard_size") if self.meta else None
+        self._shard_dir = None
+        self._search_pool = None
+        self._search_lock = threading.Lock()
+        self._background = None
+
+        # Labels in the index map to `_input_hash` values. Examples for labels are looked up
+        # in the example store when there is one. Only older indexes without a store need the
+        # source in memory, while building we stream the source and spill to a temporary store.
+        self.label_hashes = np.empty(0, dtype=np.int64)
+        self.store = None
+        self.added = None
+        self.added_start = 0
+        self.examples = []
+        if index_path and store_exists(index_path):
+            self.store = ExampleStore(index_path)
+            log(f"INDEX: Using example store for {index_path}, source is not loaded into memory.")
+        elif index_path:
+            self.examples = list(self._read_source())
+        self.positions = self._positions(self.examples)
 
         # If path is given, load from disk otherwise assume start from scratch
         if not index_path:
-            self.index.init_index(max_elements=len(self.examples))
+            self.shards = [self._new_shard()]
         else:
-            self.index.load_index(str(index_path), max_elements=len(self.examples))
-            log(f"RECIPE: Loaded index from {index_path}")
-    
-    def build_index(self, setting: Literal["text", "image"] = "text") -> "ApproximateIndex":
+            with self.metrics.timer("load"):
+                shard_names = self.meta.get("shards") if self.meta else None
+                if shard_names:
+                    # Shards are only loaded once they're searched, exact shards are memory-mapped.
+                    count = self.meta["count"]
+                    sizes = self.meta.get("shard_counts") or [
+                        min(self.shard_size, count - i * self.shard_size) for i in range(len(shard_names))
+                    ]
+                    self.shards = [
+                        self._lazy_shard(Path(index_path).parent / name, loaded_backend, size)
+                        for name, size in zip(shard_names, sizes)
+                    ]
+                else:
+                    self.shards = [self._load_shard(index_path, loaded_backend, max_elements=len(self.examples))]
+                log(f"RECIPE: Loaded index from {index_path}")
+                if self.backend not in ("auto", loaded_backend):
+                    log(f"INDEX: Converting {loaded_backend} index to {self.backend} backend.")
+                    self.shards = [self._convert(shard, self.backend) for shard in self.shards]
+                elif self.quantize != (self.meta.get("quantize") if self.meta else None):
+                    log(f"INDEX: Converting index to {self.quantize or 'float32'} vectors.")
+                    self.shards = [self._convert(shard, "exact") for shard in self.shards]
+            if hashes_path(index_path).exists():
+                self.label_hashes = np.load(hashes_path(index_path))
+            else:
+                # Older indexes don't have a mapping, their labels are positions in the source.
+                self.label_hashes = np.array([ex["_input_hash"] for ex in self.examples[:len(self)]], dtype=np.int64)
+
+        # Filters on `meta` fields are resolved to the allowed labels with an inverted index,
+        # and a BM25 index over the texts allows for hybrid lexical and semantic search.
+        self.filters = MetaIndex.load(index_path) if index_path else None
+        self.filter_labels = LRUCache(query_cache_size)
+        self.lexical = LexicalIndex.load(index_path) if index_path else None
+        new_filters = filter_fields and (self.filters is None or self.filters.fields != list(filter_fields))
+        new_lexical = lexical and self.lexical is None
+        if new_filters:
+            self.filters = MetaIndex(filter_fields)
+        if new_lexical:
+            self.lexical = LexicalIndex()
+        if new_filters or new_lexical:
+            # Add the examples that are already in the index.
+            for label in range(len(self.label_hashes)):
+                ex = self.get_example(label) or {}
+                if new_filters:
+                    self.filters.add(label, ex)
+                if new_lexical:
+                    self.lexical.add(label, self._label_text(label, ex))
+
+        # Near-duplicates within `dedup_threshold` distance are clustered, and new streams only
+        # show the best match of every cluster. Clusters are found again if the threshold changes.
+        self.clusters = load_clusters(index_path) if index_path else None
+        built_threshold = self.meta.get("dedup_threshold") if self.meta else None
+        self.dedup_threshold = built_threshold if dedup_threshold is None else dedup_threshold
+        if self.dedup_threshold != built_threshold:
+            self.clusters = None
+
+    @property
+    def index(self):
+        """The shard that new examples are added to."""
+        return self.shards[-1]
+
+    @property
+    def hnsw_settings(self):
+        return {"hnsw_m": self.hnsw_m, "ef_construction": self.ef_construction, "ef": self.ef}
+
+    def _backend_settings(self, name: str) -> Dict:
+        settings = {"max_size": self.shard_size, **self.hnsw_settings}
+        if name == "exact":
+            settings.update(quantize=self.quantize, rerank=self.rerank)
+        return settings
+
+    def _new_shard(self):
+        name = "exact" if self.backend == "auto" else self.backend
+        return BACKENDS[name](self.space, self.dim, **self._backend_settings(name))
+
+    def _load_shard(self, path: Path, name: str, max_elements: int = 0):
+        return BACKENDS[name].load(
+            path, self.space, self.dim, ef=self.ef, max_size=self.shard_size, max_elements=max_elements
+        )
+
+    def _lazy_shard(self, path: Path, name: str, size: int) -> LazyShard:
+        return LazyShard(path, name, size, lambda shard_path: self._load_shard(shard_path, name))
+
+    def _release_full_shards(self):
+        """Write full shards to disk while building, so only the shard that's being filled stays in memory."""
+        if self._shard_dir is None:
+            self._shard_dir = tempfile.TemporaryDirectory(prefix="prodigy-ann-shards-")
+        for i, shard in enumerate(self.shards[:-1]):
+            if not isinstance(shard, LazyShard):
+                path = Path(self._shard_dir.name) / f"shard-{i}"
+                shard.save(path)
+                self.shards[i] = self._lazy_shard(path, shard.name, len(shard))
+
+    def _convert(self, shard, name: str):
+        return convert(shard, name, self.space, self.dim, **self._backend_settings(name))
+
+    @property
+    def model(self) -> "SentenceTransformer":
+        if self._model is None:
+            with self.metrics.timer("model_load"):
+                self._model = load_model(self.model_name, self.inference)
+        return self._model
+
+    def _check_model(self, model_name: Optional[str], default_model: Optional[str] = None) -> str:
+        """The model to encode with, vectors of another model than the index was built with are meaningless.
+
+        Indexes without metadata don't record their model, they fall back to `default_model`.
+        """
+        built_with = self.meta.get("model_name") if self.meta else None
+        if model_name is None:
+            model_name = built_with or default_model
+            if model_name is None:
+                raise ValueError("Pass a model name, the index doesn't record which model it was built with.")
+            return model_name
+        if built_with is not None and model_name != built_with:
+            msg.fail(
+                f"The index at {self.index_path} was built with {built_with}, not {model_name}. "
+                f"Queries need to be encoded by the same model, leave out `--model` to use {built_with}.",
+                exits=True,
+            )
+        return model_name
+
+    def _check_source(self):
+        fingerprint = source_fingerprint(self.source)
+        if fingerprint is None or fingerprint == self.meta.get("source_fingerprint"):
+            return
+        msg.warn(
+            f"Source {self.source} has changed since the index at {self.index_path} was built. "
+            "Examples are served from the index as it was built, re-index with `--update` to add new ones."
+        )
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def stats(self) -> Dict:
+        """Calls, items, time and peak memory growth per stage, with the memory of the process."""
+        return self.metrics.as_dict()
+
+    def _read_source(self):
+        stream = get_stream(self.source)
+        stream.apply(self.metrics.timed, "source_read")
+        # Always add the hashes at the end to prevent warning.
+        stream.apply(add_hashes, metrics=self.metrics)
+        return stream
+
+    @staticmethod
+    def _positions(examples):
+        positions = {}
+        for i, ex in enumerate(examples):
+            positions.setdefault(ex["_input_hash"], i)
+        return positions
+
+    def get_example(self, label: int) -> Optional[dict]:
+        """Fetch the example for an index label, `None` if it's no longer in the source."""
+        if self.chunks is not None:
+            return self._get_record(int(self.chunks.docs[label]))
+        return self._get_record(label)
+
+    def _get_record(self, i: int) -> Optional[dict]:
+        # Records are examples in the order they were indexed, one per label unless texts are chunked.
+        if self.store is not None and i < len(self.store):
+            return self.store[i]
+        if self.added is not None and i >= self.added_start:
+            return self.added[i - self.added_start]
+        position = self.positions.get(int(self.label_hashes[i]))
+        if position is None:
+            return None
+        return self.examples[position]
+
+    def _n_records(self) -> int:
+        return len(self.label_hashes) if self.chunks is None else self.chunks.n_docs
+
+    def _label_text(self, label: int, ex: Dict) -> str:
+        """The text of the example or chunk behind a label."""
+        text = ex.get("text", "")
+        if self.chunks is None:
+            return text
+        start, end = self.chunks.spans[label].tolist()
+        return text[start:end]
+
+    def _split(self, examples, writer: "ExampleStoreWriter", first_record: int):
+        """Split texts into chunks, the documents are written to the store as they're split."""
+        for ex in examples:
+            record = first_record + len(writer)
+            writer.add(ex)
+            text = ex.get("text", "")
+            for start, end in chunk_spans(text, self.chunk_words):
+                # Chunks are cached by their own text, so unchanged passages are reused.
+                chunk = set_hashes({"text": text[start:end]})
+                yield {**chunk, "_example": ex, "_record": record, "_span": (start, end)}
+
+    def build_index(
+        self,
+        setting: Literal["text", "image"] = "text",
+        cache: Optional[EmbeddingCache] = None,
+        workers: int = 1,
+        shards: int = 1,
+        thumbnails: Optional["ThumbnailCache"] = None,
+        batch_size: int = BATCH_SIZE,
+    ) -> "ApproximateIndex":
         # Index everything, progbar and save
-        log(f"INDEX: About to build index with {setting=}.")
-        iter_examples = tqdm(self.examples, desc="indexing")
-        for batch in batched(iter_examples, n=256):
-            if setting == "image":
-                batch = [Image.open(ex['path']) for ex in batch]
-            embeddings = self.model.encode(batch)
-            self.index.add_items(embeddings)
-        log(f"INDEX: Indexed {len(self.examples)} examples.")
+        log(f"INDEX: About to build index with {setting=}, {workers=}, {shards=} and {batch_size=}.")
+        if shards > 1:
+            # Shards cover contiguous ranges of the source, so we need to know its size first.
+            if self.chunks is not None:
+                texts = (ex.get("text", "") for ex in get_stream(self.source))
+                n_examples = sum(len(chunk_spans(text, self.chunk_words)) for text in texts)
+            else:
+                n_examples = sum(1 for _ in get_stream(self.source))
+            self.shard_size = max(1, math.ceil(n_examples / shards))
+            self.shards = [self._new_shard()]
+        self._add_examples(
+            self._read_source(), setting, cache=cache, workers=workers, thumbnails=thumbnails, batch_size=batch_size
+        )
+        log(f"INDEX: Indexed {len(self)} examples.")
+        if self.chunks is not None:
+            log(f"INDEX: Split {self.chunks.n_docs} examples into {len(self.chunks)} chunks.")
+        self._log_caches(cache, thumbnails)
+        if self.dedup_threshold is not None:
+            self.cluster_duplicates()
         return self
 
+    def update_index(
+        self,
+        setting: Literal["text", "image"] = "text",
+        cache: Optional[EmbeddingCache] = None,
+        workers: int = 1,
+        thumbnails: Optional["ThumbnailCache"] = None,
+        batch_size: int = BATCH_SIZE,
+    ) -> "ApproximateIndex":
+        """Add the examples whose hashes aren't in the loaded index yet."""
+        known = set(self.label_hashes.tolist())
+
+        def new_examples():
+            for ex in self.examples if self.store is None else self._read_source():
+                if ex["_input_hash"] not in known:
+                    known.add(ex["_input_hash"])
+                    yield ex
+
+        log(f"INDEX: About to add new examples to index with {setting=}, {workers=} and {batch_size=}.")
+        before = len(self)
+        self._add_examples(
+            new_examples(), setting, cache=cache, workers=workers, thumbnails=thumbnails, batch_size=batch_size
+        )
+        log(f"INDEX: Added {len(self) - before} examples, index now contains {len(self)} examples.")
+        self._log_caches(cache, thumbnails)
+        if self.dedup_threshold is not None:
+            self.cluster_duplicates()
+        return self
+
+    def cluster_duplicates(self) -> np.ndarray:
+        """Cluster near-duplicates with an all-points search, only new labels are searched on updates."""
+        if self.clusters is not None and len(self.clusters) == len(self):
+            return self.clusters
+        start = 0 if self.clusters is None else len(self.clusters)
+        log(f"INDEX: Clustering near-duplicates of {len(self) - start} examples within {self.dedup_threshold}.")
+        self.clusters = find_clusters(
+            lambda vectors, k: self.knn_query(vectors, k), self.get_vectors, len(self), self.dedup_threshold,
+            roots=self.clusters,
+        )
+        n_clusters = len(np.unique(self.clusters))
+        log(f"INDEX: Found {len(self) - n_clusters} near-duplicates, {n_clusters} distinct examples remain.")
+        self.query_results.clear()
+        return self.clusters
+
+    @staticmethod
+    def _log_caches(cache: Optional[EmbeddingCache], thumbnails: Optional["ThumbnailCache"]):
+        if cache is not None:
+            log(f"INDEX: Embedding cache had {cache.hits} hits and {cache.misses} misses.")
+        if thumbnails is not None:
+            log(f"INDEX: Thumbnail cache had {thumbnails.hits} hits and {thumbnails.misses} misses.")
+
+    def _add_examples(
+        self,
+        examples,
+        setting: Literal["text", "image"] = "text",
+        cache: Optional[EmbeddingCache] = None,
+        workers: int = 1,
+        thumbnails: Optional["ThumbnailCache"] = None,
+        batch_size: int = BATCH_SIZE,
+    ):
+        """Encode and index examples in a pipeline.
+
+        A thread pool loads the upcoming batches (cache lookups happen up front so only misses
+        get decoded), the model encodes the current batch and a separate thread inserts the
+        previous batch into hnswlib. Indexed examples are spilled to a temporary store. With
+        more than one worker, batches are encoded by a pool of processes.
+        """
+        # New labels continue after the ones that are already in the index.
+        start = len(self.label_hashes)
+        first_record = self._n_records()
+        self._spill_dir = tempfile.TemporaryDirectory(prefix="prodigy-ann-")
+        spill_path = Path(self._spill_dir.name) / "added"
+        writer = ExampleStoreWriter(spill_path)
+        new_hashes = []
+        if self.chunks is not None:
+            if setting != "text":
+                raise ValueError("Only texts can be split into chunks.")
+            examples = self._split(examples, writer, first_record)
+
+        def lookup(batch):
+            found = cache.get_many(ex["_input_hash"] for ex in batch) if cache is not None else {}
+            return batch, found
+
+        def load(item):
+            batch, found = item
+            missing = [ex for ex in batch if ex["_input_hash"] not in found]
+            return self._model_inputs(missing, setting, thumbnails)
+
+        # Bigger batches give every worker process a reasonable chunk to encode.
+        batches = (lookup(batch) for batch in batched(tqdm(examples, desc="indexing"), n=batch_size * workers))
+        insert = None
+        with ThreadPoolExecutor(max_workers=1) as insert_pool, self._encoding_pool(workers):
+            for (batch, found), inputs in prefetched(batches, load):
+                embeddings = self._merge_embeddings(batch, found, inputs, cache)
+                first = start + len(new_hashes)
+                if insert is not None:
+                    insert.result()
+                insert = insert_pool.submit(self._insert, embeddings, np.arange(first, first + len(batch)))
+                if self.chunks is not None:
+                    docs = [chunk["_example"] for chunk in batch]
+                    self.chunks.add((chunk["_record"] for chunk in batch), (chunk["_span"] for chunk in batch))
+                else:
+                    docs = batch
+                    for ex in batch:
+                        writer.add(ex)
+                new_hashes.extend(doc["_input_hash"] for doc in docs)
+                for label, (ex, doc) in enumerate(zip(batch, docs), first):
+                    if self.filters is not None:
+                        self.filters.add(label, doc)
+                    if self.lexical is not None:
+                        self.lexical.add(label, ex.get("text", ""))
+            if insert is not None:
+                insert.result()
+        writer.close()
+        self.label_hashes = np.concatenate([self.label_hashes, np.array(new_hashes, dtype=np.int64)])
+        self.added = ExampleStore(spill_path)
+        self.added_start = first_record
+        self.query_results.clear()
+
+    def _insert(self, embeddings: np.ndarray, ids: np.ndarray):
+        switch = self.backend == "auto" and not self.quantize and self.index.name == "exact"
+        if switch and len(self) + len(ids) > EXACT_THRESHOLD:
+            log(f"INDEX: More than {EXACT_THRESHOLD} examples, switching from exact search to hnswlib.")
+            self.shards = [self._convert(shard, "hnsw") for shard in self.shards]
+            if self.shard_size:
+                self._release_full_shards()
+        while len(ids):
+            if self.shard_size and len(self.index) >= self.shard_size:
+                self.shards.append(self._new_shard())
+                self._release_full_shards()
+            take = len(ids)
+            if self.shard_size:
+                take = min(take, self.shard_size - len(self.index))
+            with self.metrics.timer("add_items", items=take):
+                self.index.add(embeddings[:take], ids[:take])
+            embeddings, ids = embeddings[take:], ids[take:]
+
+    def encode_source(self, setting: Literal["text", "image"] = "text", batch_size: int = BATCH_SIZE) -> np.ndarray:
+        """Embeddings for the whole source, in source order."""
+        batches = batched(tqdm(self._read_source(), desc="encoding"), n=batch_size)
+        return np.concatenate([self.encode_examples(batch, setting=setting) for batch in batches])
+
+    def encode_examples(
+        self,
+        batch,
+        setting: Literal["text", "image"] = "text",
+        cache: Optional[EmbeddingCache] = None,
+        thumbnails: Optional["ThumbnailCache"] = None,
+    ) -> np.ndarray:
+        """Encode a batch of examples, only running the model on cache misses."""
+        found = cache.get_many(ex["_input_hash"] for ex in batch) if cache is not None else {}
+        missing = [ex for ex in batch if ex["_input_hash"] not in found]
+        return self._merge_embeddings(batch, found, self._model_inputs(missing, setting, thumbnails), cache)
+
+    def _merge_embeddings(self, batch, found, inputs, cache: Optional[EmbeddingCache] = None) -> np.ndarray:
+        # `inputs` are the loaded model inputs for the examples that weren't found in the cache.
+        if cache is None:
+            return self._encode(inputs)
+        hashes = [ex["_input_hash"] for ex in batch]
+        if inputs:
+            new_embeddings = self._encode(inputs)
+            new_hashes = [ex["_input_hash"] for ex in batch if ex["_input_hash"] not in found]
+            if cache is not None:
+                cache.put_many(new_hashes, new_embeddings)
+            found.update(zip(new_hashes, new_embeddings))
+        return np.stack([found[h] for h in hashes])
+
+    @contextmanager
+    def _encoding_pool(self, workers: int = 1):
+        if workers <= 1:
+            yield
+            return
+        # Each process gets its share of the cores, otherwise torch threads oversubscribe the CPU.
+        threads = str(max(1, (os.cpu_count() or 1) // workers))
+        previous = os.environ.get("OMP_NUM_THREADS")
+        os.environ["OMP_NUM_THREADS"] = threads
+        try:
+            self._pool = self.model.start_multi_process_pool(target_devices=["cpu"] * workers)
+        finally:
+            if previous is None:
+                del os.environ["OMP_NUM_THREADS"]
+            else:
+                os.environ["OMP_NUM_THREADS"] = previous
+        log(f"INDEX: Started pool of {workers} encoding processes with {threads} threads each.")
+        try:
+            yield
+        finally:
+            self.model.stop_multi_process_pool(self._pool)
+            self._pool = None
+
+    def _encode(self, inputs) -> np.ndarray:
+        model = self.model
+        with self.metrics.timer("encode", items=len(inputs)):
+            if self._pool is not None:
+                return model.encode_multi_process(inputs, self._pool)
+            return model.encode(inputs)
+
+    @staticmethod
+    def _model_inputs(
+        batch, setting: Literal["text", "image"] = "text", thumbnails: Optional["ThumbnailCache"] = None
+    ):
+        if setting == "image":
+            from .thumbnails import load_image
+
+            # Decode here rather than lazily inside the model, so it happens in the loading thread.
+            return [load_image(ex, thumbnails=thumbnails) for ex in batch]
+        return [ex['text'] for ex in batch]
+
     def store_index(self, path: Path):
-        self.index.save_index(str(path))
+        with self.metrics.timer("save"):
+            self._store_index(path)
+
+    def _store_index(self, path: Path):
+        shard_info = {}
+        if self.shard_size:
+            shard_names = [f"{Path(path).name}.shard-{i}" for i in range(len(self.shards))]
+            for shard, name in zip(self.shards, shard_names):
+                shard.save(Path(path).parent / name)
+            shard_info = {
+                "shards": shard_names, "shard_size": self.shard_size, "shard_counts": [len(s) for s in self.shards]
+            }
+        else:
+            self.index.save(path)
+        np.save(hashes_path(path), self.label_hashes)
+        self._store_examples(path)
+        if self.filters is not None:
+            self.filters.save(path)
+        if self.lexical is not None:
+            self.lexical.save(path)
+        if self.clusters is not None:
+            save_clusters(path, self.clusters)
+        if self.chunks is not None:
+            self.chunks.save(path)
+        write_metadata(path, {
+            "model_name": self.model_name,
+            "inference": self.inference,
+            "dim": self.dim,
+            "space": self.space,
+            "count": len(self),
+            "backend": self.index.name,
+            "backend_mode": self.backend,
+            "quantize": self.quantize,
+            "rerank": self.rerank,
+            "filter_fields": self.filters.fields if self.filters is not None else None,
+            "lexical": self.lexical is not None,
+            "dedup_threshold": self.dedup_threshold if self.clusters is not None else None,
+            "chunk_words": self.chunk_words,
+            "hnsw": {"M": self.hnsw_m, "ef_construction": self.ef_construction, "ef": self.ef},
+            **shard_info,
+            "source": str(self.source),
+            "source_fingerprint": source_fingerprint(self.source),
+            "hashes": hashes_path(path).name,
+        })
         log(f"INDEX: Index file stored at {path}.")
-    
-    def new_stream(self, query:str, n:int=100):
+
+    def _store_examples(self, path: Path):
+        # Examples that are already in a loaded store are kept, everything else is appended.
+        if self.store is None and self.added is not None and self.added_start == 0:
+            # Freshly built, the spilled examples become the store.
+            self.added.close()
+            for src, dst in zip(store_paths(self.added.index_path), store_paths(path)):
+                shutil.move(src, dst)
+            self.store, self.added = ExampleStore(path), None
+            log(f"INDEX: Example store with {len(self.store)} examples stored next to {path}.")
+            return
+        if self.store is not None:
+            if store_paths(path)[0].resolve() != self.store.records_path.resolve():
+                copy_store(self.store.index_path, path)
+            writer = ExampleStoreWriter(path, append=True)
+        else:
+            writer = ExampleStoreWriter(path)
+        for i in range(len(writer), self._n_records()):
+            writer.add(self._get_record(i))
+        writer.close()
+        log(f"INDEX: Example store with {len(writer)} examples stored next to {path}.")
+
+    def knn_query(self, vectors, k: int, allowed: Optional[np.ndarray] = None):
+        """Query all shards in parallel and merge their top-k by distance.
+
+        With `allowed`, only the examples with those (sorted) labels are searched. Shards hold
+        contiguous ranges of labels, so every shard only gets the labels in its range.
+        """
+        with self.metrics.timer("knn_query", items=len(vectors)):
+            return self._knn_query(vectors, k, allowed)
+
+    def _knn_query(self, vectors, k: int, allowed: Optional[np.ndarray] = None):
+        searches = []
+        for i, shard in enumerate(self.shards):
+            shard_allowed = allowed
+            if allowed is not None and self.shard_size:
+                start, end = np.searchsorted(allowed, [i * self.shard_size, (i + 1) * self.shard_size])
+                shard_allowed = allowed[start:end]
+            size = len(shard) if shard_allowed is None else min(len(shard), len(shard_allowed))
+            if size > 0:
+                searches.append((shard, min(k, size), shard_allowed))
+        if not searches:
+            return np.empty((len(vectors), 0), dtype=np.int64), np.empty((len(vectors), 0), dtype=np.float32)
+        if len(searches) == 1:
+            shard, shard_k, shard_allowed = searches[0]
+            return shard.knn_query(vectors, k=k if allowed is None else shard_k, allowed=shard_allowed)
+        with self._search_lock:
+            # A new stream searches from the main thread and a background thread at the same time.
+            if self._search_pool is None:
+                self._search_pool = ThreadPoolExecutor(max_workers=len(self.shards))
+        results = list(self._search_pool.map(
+            lambda search: search[0].knn_query(vectors, k=search[1], allowed=search[2]), searches
+        ))
+        labels = np.concatenate([labels for labels, _ in results], axis=1)
+        distances = np.concatenate([distances for _, distances in results], axis=1)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(labels, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+    def encode_query(self, query: str) -> np.ndarray:
+        return self.encode_queries([query])[0]
+
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """Encode queries in a single batch, skipping the ones that are cached."""
+        embeddings = {query: self.query_embeddings.get(query) for query in queries}
+        missing = list({query: None for query, emb in embeddings.items() if emb is None})
+        if missing:
+            model = self.model
+            with self.metrics.timer("query_encode", items=len(missing)):
+                encoded = model.encode([unescape(query) for query in missing])
+            if encoded.shape[1] != self.dim:
+                raise ValueError(
+                    f"{self.model_name} gives vectors of {encoded.shape[1]} dimensions, the index has {self.dim}."
+                )
+            for query, embedding in zip(missing, encoded):
+                self.query_embeddings.put(query, embedding)
+                embeddings[query] = embedding
+        return np.stack([embeddings[query] for query in queries])
+
+    def search(self, query: str, n: int = 100, meta_filter: Optional[str] = None):
+        """Labels and distances of the `n` nearest neighbours of a query, cached per `(query, n, meta_filter)`."""
+        result = self.query_results.get((query, n, meta_filter))
+        if result is None:
+            allowed = self.allowed_labels(meta_filter)
+            if is_multi_query(query):
+                result = self._multi_query(parse_query(query), k=n, allowed=allowed)
+            else:
+                result = self._query([query], [self.encode_query(query)], k=n, allowed=allowed)
+            self.query_results.put((query, n, meta_filter), result)
+        return result
+
+    def _part_vectors(self, parts: List[QueryPart]) -> np.ndarray:
+        """Vectors of query parts, texts are encoded and examples use their stored vectors."""
+        vectors = np.empty((len(parts), self.dim), dtype=np.float32)
+        texts = [i for i, part in enumerate(parts) if part.label is None]
+        examples = [i for i, part in enumerate(parts) if part.label is not None]
+        if texts:
+            vectors[texts] = self.encode_queries([parts[i].text for i in texts])
+        if examples:
+            labels = [parts[i].label for i in examples]
+            if max(labels) >= len(self):
+                raise ValueError(f"Example @{max(labels)} isn't in the index, it has {len(self)} examples.")
+            vectors[examples] = self.get_vectors(labels)
+        return normalize(vectors)
+
+    def _multi_query(self, parts: List[QueryPart], k: int, allowed: Optional[np.ndarray] = None):
+        """Candidates of all positive parts from one batched search, ranked by their weighted similarity.
+
+        Every candidate scores the weighted sum of its similarities to the positive parts minus
+        those to the negative parts, relative to the total weight of the positive parts.
+        """
+        positive = [i for i, part in enumerate(parts) if not part.negative]
+        if not positive:
+            raise ValueError("A query needs at least one part that isn't negative.")
+        vectors = self._part_vectors(parts)
+        queries = [parts[i].text or "" for i in positive]
+        items, _ = self._query(queries, vectors[positive], k=k, allowed=allowed)
+        candidates = np.unique(np.asarray(items, dtype=np.int64))
+        weights = np.array([-part.weight if part.negative else part.weight for part in parts], dtype=np.float32)
+        scores = normalize(self.get_vectors(candidates)) @ vectors.T @ weights / weights[positive].sum()
+        top = np.argsort(-scores, kind="stable")[:k]
+        return candidates[top][None, :], (1.0 - scores[top]).astype(np.float32)[None, :]
+
+    def query_vector(self, query: str) -> np.ndarray:
+        """A single vector for a query, multi-part queries combine the vectors of their parts."""
+        if not is_multi_query(query):
+            return self.encode_query(query)
+        parts = parse_query(query)
+        weights = np.array([-part.weight if part.negative else part.weight for part in parts], dtype=np.float32)
+        return weights @ self._part_vectors(parts)
+
+    def _query(self, queries: List[str], vectors, k: int, allowed: Optional[np.ndarray] = None):
+        """Nearest neighbours of query vectors, fused with the BM25 results if the index has them."""
+        items, distances = self.knn_query(vectors, k=k, allowed=allowed)
+        if self.lexical is None:
+            return items, distances
+        fused = [self._fuse(*args, k=k, allowed=allowed) for args in zip(queries, vectors, items, distances)]
+        return np.stack([labels for labels, _ in fused]), np.stack([distances for _, distances in fused])
+
+    def _fuse(self, query: str, vector, labels, distances, k: int, allowed: Optional[np.ndarray] = None):
+        lexical_labels, _ = self.lexical.search(unescape(query), k, allowed=allowed)
+        if not len(lexical_labels):
+            return labels, distances
+        fused = reciprocal_rank_fusion([labels, lexical_labels], k)
+        # Report the semantic distance for every result, also the ones only BM25 found.
+        known = dict(zip(labels.tolist(), distances.tolist()))
+        missing = [label for label in fused.tolist() if label not in known]
+        if missing:
+            scores = normalize(self.get_vectors(missing)) @ normalize(np.asarray([vector]))[0]
+            known.update(zip(missing, (1.0 - scores).tolist()))
+        return fused, np.array([known[label] for label in fused.tolist()], dtype=np.float32)
+
+    def get_vectors(self, labels) -> np.ndarray:
+        """Stored vectors for index labels, from the shards that hold them."""
+        labels = np.asarray(labels, dtype=np.int64)
+        if not self.shard_size:
+            return self.index.get_items(labels)
+        vectors = np.empty((len(labels), self.dim), dtype=np.float32)
+        shard_ids = labels // self.shard_size
+        for i in np.unique(shard_ids).tolist():
+            vectors[shard_ids == i] = self.shards[i].get_items(labels[shard_ids == i])
+        return vectors
+
+    def allowed_labels(self, meta_filter: Optional[str] = None) -> Optional[np.ndarray]:
+        """Sorted labels of the examples that match a filter like `lang=de|en,source=crm`."""
+        if not meta_filter:
+            return None
+        if self.filters is None:
+            raise ValueError("This index has no metadata filters, build it with --filter-fields.")
+        labels = self.filter_labels.get(meta_filter)
+        if labels is None:
+            labels = self.filters.labels(parse_filter(meta_filter))
+            log(f"INDEX: {len(labels)} examples match {meta_filter=}.")
+            self.filter_labels.put(meta_filter, labels)
+        return labels
+
+    def exclude(self, hashes: Iterable[int]):
+        """Skip examples with these input hashes in new streams."""
+        self.excluded.update(hashes)
+
+    def _fresh(self, labels: np.ndarray, distances: np.ndarray):
+        keep = np.array([h not in self.excluded for h in self.label_hashes[labels].tolist()], dtype=bool)
+        if self.clusters is not None or self.chunks is not None:
+            # Only the best match of every cluster of near-duplicates, or of every document, is kept.
+            _, first = np.unique(self.cluster_ids(labels), return_index=True)
+            keep &= np.isin(np.arange(len(labels)), first)
+        return labels[keep], distances[keep]
+
+    def cluster_ids(self, labels: np.ndarray) -> np.ndarray:
+        """The cluster of near-duplicates of every label, labels without clusters are their own.
+
+        Chunks of the same document are one cluster, so documents are ranked by their best chunk.
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        if self.clusters is not None:
+            labels = self.clusters[labels]
+        if self.chunks is not None:
+            labels = self.chunks.docs[labels]
+        return labels
+
+    def search_fresh(self, query: str, n: int = 100, meta_filter: Optional[str] = None):
+        """Labels and distances of the `n` nearest neighbours of a query that aren't excluded.
+
+        Over-fetches until there are `n` fresh results, the raw results stay cached per `k`
+        so they remain valid as more examples get excluded.
+        """
+        allowed = self.allowed_labels(meta_filter)
+        available = len(self) if allowed is None else len(allowed)
+        k = min(n, available)
+        while True:
+            items, distances = self.search(query, n=k, meta_filter=meta_filter)
+            labels, distances = self._fresh(items[0], distances[0])
+            if len(labels) >= n or k == available:
+                return labels[:n], distances[:n]
+            k = min(available, max(2 * k, n + 2 * (k - len(labels))))
+
+    def new_stream(
+        self,
+        query: str,
+        n: int = 100,
+        first: int = FIRST_RESULTS,
+        meta_filter: Optional[str] = None,
+        diversity: float = 0.0,
+    ):
+        """Stream the `n` nearest neighbours of a query, starting as soon as the top `first` are found.
+
+        The full search runs in a background thread while the first results are annotated, and
+        examples are only looked up and hashed once the stream gets to them. With `diversity`,
+        results are picked from more candidates with maximal marginal relevance. Those picks
+        depend on the whole pool of candidates, so these streams start after the full search.
+        """
         log(f"INDEX: Creating new stream of {n} examples using {query=}.")
-        if len(self.examples) < n:
-            msg.fail(f"Number of examples, {len(self.examples)}, in index is smaller than query size, {n}. Reduce `--n`.", exits=True)
-        embedding = self.model.encode([query])[0]
-        items, distances = self.index.knn_query([embedding], k=n)
-        for lab, dist in zip(items[0].tolist(), distances[0].tolist()):
-            # Get the original example
-            ex = self.examples[int(lab)]
+        self._check_n(n)
+        candidates = MMR_CANDIDATES if diversity else 1
+        cached = self.query_results.get((query, n * candidates, meta_filter)) is not None
+        # Multi-part queries and diverse picks rank all candidates together, so they can't start early.
+        if n <= first or cached or diversity or is_multi_query(query):
+            yield from self._results_to_examples(*self.ranked(query, n, meta_filter, diversity), query)
+            return
+        # Encode up front, so the background search finds the embedding in the cache.
+        vector = self.encode_query(query)
+        if self._background is None:
+            self._background = ThreadPoolExecutor(max_workers=1)
+        future = self._background.submit(self.ranked, query, n, meta_filter)
+        allowed = self.allowed_labels(meta_filter)
+        items, distances = self._query([query], [vector], k=min(first, len(self)), allowed=allowed)
+        labels, distances = self._fresh(items[0], distances[0])
+        yield from self._results_to_examples(labels, distances, query)
+        seen = set(self.cluster_ids(labels).tolist())
+        labels, distances = future.result()
+        fresh = [cluster not in seen for cluster in self.cluster_ids(labels).tolist()]
+        rest = np.flatnonzero(fresh)[:n - len(seen)]
+        yield from self._results_to_examples(labels[rest], distances[rest], query)
+
+    def ranked(self, query: str, n: int = 100, meta_filter: Optional[str] = None, diversity: float = 0.0):
+        """Labels and distances of `n` fresh results for a query, picked for diversity if asked for."""
+        if not diversity:
+            return self.search_fresh(query, n=n, meta_filter=meta_filter)
+        labels, distances = self.search_fresh(query, n=n * MMR_CANDIDATES, meta_filter=meta_filter)
+        return self._diversify(self.query_vector(query), labels, distances, n, diversity)
+
+    def _diversify(self, vector, labels: np.ndarray, distances: np.ndarray, n: int, diversity: float):
+        if not len(labels):
+            return labels, distances
+        order = maximal_marginal_relevance(vector, self.get_vectors(labels), n, diversity)
+        return labels[order], distances[order]
+
+    def new_streams(
+        self, queries: List[str], n: int = 100, meta_filter: Optional[str] = None, diversity: float = 0.0
+    ) -> List[Iterator[dict]]:
+        """One stream per query, using a single batched encode and `knn_query` for all of them."""
+        log(f"INDEX: Creating {len(queries)} new streams of {n} examples.")
+        self._check_n(n)
+        allowed = self.allowed_labels(meta_filter)
+        # Multi-part queries are ranked on their own, all other queries share one batched search.
+        plain = [query for query in queries if not is_multi_query(query)]
+        vectors = self.encode_queries(plain) if plain else np.empty((0, self.dim), dtype=np.float32)
+        candidates = MMR_CANDIDATES if diversity else 1
+        if plain:
+            items, distances = self._query(plain, vectors, k=min(n * candidates, len(self)), allowed=allowed)
+        streams, i = [], 0
+        for query in queries:
+            if not is_multi_query(query):
+                labels, query_distances = self._fresh(items[i], distances[i])
+                skipped = len(labels) < len(items[i])
+                if diversity and not skipped:
+                    labels, query_distances = self._diversify(vectors[i], labels, query_distances, n, diversity)
+                i += 1
+            if is_multi_query(query) or skipped:
+                # Queries with skipped results need more candidates, which `ranked` fetches.
+                labels, query_distances = self.ranked(query, n, meta_filter=meta_filter, diversity=diversity)
+            streams.append(self._results_to_examples(labels, query_distances, query))
+        return streams
+
+    def combined_stream(
+        self, queries: List[str], n: int = 100, meta_filter: Optional[str] = None, diversity: float = 0.0
+    ) -> Iterator[dict]:
+        """Results for all queries, deduplicated and tagged with every query that found them."""
+        found = {}
+        for stream in self.new_streams(queries, n=n, meta_filter=meta_filter, diversity=diversity):
+            for ex in stream:
+                # Near-duplicates found by different queries are one result too.
+                key = ex["_input_hash"] if self.clusters is None else int(self.cluster_ids([ex["meta"]["index"]])[0])
+                if key not in found:
+                    found[key] = ex
+                    ex["meta"]["queries"] = [ex["meta"]["query"]]
+                    continue
+                best = found[key]
+                if ex["meta"]["query"] not in best["meta"]["queries"]:
+                    best["meta"]["queries"].append(ex["meta"]["query"])
+                if ex["meta"]["distance"] < best["meta"]["distance"]:
+                    ex["meta"]["queries"] = best["meta"]["queries"]
+                    found[key] = ex
+        yield from sorted(found.values(), key=lambda ex: ex["meta"]["distance"])
+
+    def _check_n(self, n: int):
+        size = len(self) if self.chunks is None else self.chunks.n_docs
+        if size < n:
+            msg.fail(
+                f"Number of examples, {size}, in index is smaller than query size, {n}. Reduce `--n`.", exits=True
+            )
+
+    def _results_to_examples(self, labels: np.ndarray, distances: np.ndarray, query: str):
+        for lab, dist in zip(labels.tolist(), distances.tolist()):
+            # Get the original example, it may have been removed from the source since indexing
+            start = time.perf_counter()
+            ex = self.get_example(int(lab))
+            self.metrics.add("example_lookup", time.perf_counter() - start)
+            if ex is None:
+                continue
 
             # Add some extra meta info
             ex['meta'] = ex.get("meta", {})
             ex['meta']['index'] = int(lab)
             ex['meta']['distance'] = float(dist)
             ex['meta']["query"] = query
-            
+            if self.chunks is not None:
+                # Character offsets of the chunk that matched.
+                ex['meta']['passage'] = self.chunks.spans[lab].tolist()
+
             # Don't forget hashes
             yield set_hashes(ex)
 
 
-def stream_reset_calback(index_obj: ApproximateIndex, n:int=100):
+def passage_stream(stream):
+    """Only show the passage that matched, for indexes of chunked texts.
+
+    The text is cut to the passage, its character offsets in the document stay in the meta.
+    Tasks keep the hashes of their document, so an annotated passage excludes the document.
+    """
+    for ex in stream:
+        passage = ex.get("meta", {}).get("passage")
+        if passage is not None:
+            start, end = passage
+            ex["text"] = ex["text"][start:end]
+        yield ex
+
+
+def stream_reset_calback(
+    index_obj: ApproximateIndex,
+    n:int=100,
+    meta_filter: Optional[str] = None,
+    diversity: float = 0.0,
+    stats_path: Optional[Path] = None,
+    passages: bool = False,
+):
     def stream_reset(ctrl: Controller, *, query: str):
-        new_stream = Stream.from_iterable(index_obj.new_stream(query, n=n))
+        stream = index_obj.new_stream(query, n=n, meta_filter=meta_filter, diversity=diversity)
+        if passages:
+            stream = passage_stream(stream)
+        new_stream = Stream.from_iterable(stream)
         ctrl.reset_stream(new_stream, prepend_old_wrappers=True)
-        return next(ctrl.stream)
+        first = next(ctrl.stream)
+        if stats_path is not None:
+            index_obj.metrics.write(stats_path)
+        return first
     return stream_reset
 
 
+def write_stats_on_exit(components: Dict, index_obj: ApproximateIndex, stats_path: Optional[Path] = None) -> Dict:
+    """Write the stats of the index when the server stops, if there's a path to write them to."""
+    if stats_path is None:
+        return components
+    on_exit = components.get("on_exit")
+
+    def write_stats(ctrl):
+        index_obj.metrics.write(stats_path)
+        log(f"RECIPE: Stats stored at {stats_path}")
+        if on_exit is not None:
+            return on_exit(ctrl)
+
+    components["on_exit"] = write_stats
+    return components
+
+
+def exclude_annotated(components: Dict, index_obj: ApproximateIndex, dataset: str) -> Dict:
+    """Keep annotated examples out of new streams, including answers that arrive later on."""
+    db = connect()
+    if dataset in db:
+        index_obj.exclude(db.get_input_hashes(dataset))
+        log(f"RECIPE: Excluding {len(index_obj.excluded)} examples that are already in {dataset}.")
+    update = components.get("update")
+
+    def exclude_answers(answers):
+        index_obj.exclude(eg["_input_hash"] for eg in answers)
+        if update is not None:
+            return update(answers)
+
+    components["update"] = exclude_answers
+    return components
+
+
+def read_queries(path: Path) -> List[str]:
+    """Read queries from a text file with one query per line, or JSONL with a "query" key."""
+    if Path(path).suffix == ".jsonl":
+        return [ex["query"] for ex in srsly.read_jsonl(path)]
+    lines = Path(path).read_text(encoding="utf8").splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+def write_fetched(
+    index: ApproximateIndex,
+    out_path: Path,
+    query: Optional[str] = None,
+    queries: Optional[Path] = None,
+    n: int = 100,
+    combine: bool = False,
+    remove_base64: bool = False,
+    meta_filter: Optional[str] = None,
+    diversity: float = 0.0,
+):
+    """Write the results for a single query, or for a file of queries, to disk.
+
+    For a file of queries, `out_path` is either a folder with one JSONL file per
+    query or, with `combine`, a single JSONL file with deduplicated results.
+    """
+    if not query and not queries:
+        raise ValueError("must pass query or queries")
+    if query:
+        streams = {out_path: index.new_stream(query, n=n, meta_filter=meta_filter, diversity=diversity)}
+    else:
+        query_list = read_queries(queries)
+        if combine:
+            streams = {out_path: index.combined_stream(query_list, n=n, meta_filter=meta_filter, diversity=diversity)}
+        else:
+            Path(out_path).mkdir(parents=True, exist_ok=True)
+            streams = {}
+            new_streams = index.new_streams(query_list, n=n, meta_filter=meta_filter, diversity=diversity)
+            for i, (q, stream) in enumerate(zip(query_list, new_streams)):
+                slug = re.sub(r"[^\w-]+", "_", q)[:50]
+                streams[Path(out_path) / f"{i:04d}-{slug}.jsonl"] = stream
+    for path, stream in streams.items():
+        if remove_base64:
+            stream = remove_images(stream)
+        srsly.write_jsonl(path, stream)
+        log(f"RECIPE: New stream stored at {path}")
+
+
 def remove_images(examples):
     # Remove all data URIs before storing example in the database
     for eg in examples:
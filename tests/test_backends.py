@@ -0,0 +1,152 @@
+import numpy as np
+
+from prodigy_ann.backends import ExactBackend, HnswBackend, LazyShard, convert, maximal_marginal_relevance, top_k
+
+
+def _vectors(n=300, dim=8):
+    return np.random.default_rng(0).standard_normal((n, dim)).astype(np.float32)
+
+
+def test_exact_backend_matches_hnsw():
+    vectors = _vectors()
+    ids = np.arange(len(vectors))
+    exact = ExactBackend("cosine", 8)
+    hnsw = HnswBackend("cosine", 8, hnsw_m=16, ef_construction=200, ef=300)
+    for start in range(0, len(vectors), 64):
+        exact.add(vectors[start:start + 64], ids[start:start + 64])
+        hnsw.add(vectors[start:start + 64], ids[start:start + 64])
+
+    exact_labels, exact_distances = exact.knn_query(vectors[:5], k=10)
+    hnsw_labels, hnsw_distances = hnsw.knn_query(vectors[:5], k=10)
+    assert exact_labels[:, 0].tolist() == list(range(5))
+    np.testing.assert_array_equal(exact_labels, hnsw_labels)
+    np.testing.assert_allclose(exact_distances, hnsw_distances, atol=1e-5)
+
+
+def test_exact_backend_save_and_convert(tmpdir):
+    vectors = _vectors()
+    exact = ExactBackend("cosine", 8)
+    exact.add(vectors, np.arange(len(vectors)) + 1000)
+    exact.save(tmpdir / "exact.index")
+
+    loaded = ExactBackend.load(tmpdir / "exact.index", "cosine", 8)
+    assert isinstance(loaded.vectors, np.memmap)
+    labels, _ = loaded.knn_query(vectors[:1], k=1)
+    assert labels.tolist() == [[1000]]
+
+    hnsw = convert(loaded, "hnsw", "cosine", 8, hnsw_m=16, ef_construction=200, ef=50)
+    assert len(hnsw) == len(vectors)
+    np.testing.assert_allclose(hnsw.get_items([1000, 1001]), loaded.get_items([1000, 1001]), atol=1e-6)
+
+
+def test_exact_backend_save_over_loaded(tmpdir):
+    vectors = _vectors()
+    exact = ExactBackend("cosine", 8)
+    exact.add(vectors, np.arange(len(vectors)))
+    exact.save(tmpdir / "exact.index")
+
+    # The loaded vectors are mapped from the file that gets overwritten.
+    loaded = ExactBackend.load(tmpdir / "exact.index", "cosine", 8)
+    loaded.save(tmpdir / "exact.index")
+    np.testing.assert_array_equal(loaded.vectors, exact.vectors)
+    reloaded = ExactBackend.load(tmpdir / "exact.index", "cosine", 8)
+    np.testing.assert_array_equal(reloaded.vectors, exact.vectors)
+
+
+def test_lazy_shard(tmpdir):
+    vectors = _vectors()
+    exact = ExactBackend("cosine", 8)
+    exact.add(vectors, np.arange(len(vectors)))
+    exact.save(tmpdir / "shard-0")
+    shard = LazyShard(tmpdir / "shard-0", "exact", len(vectors), lambda path: ExactBackend.load(path, "cosine", 8))
+    # Saving and counting don't need the vectors, searching does.
+    assert len(shard) == len(vectors) and shard.name == "exact"
+    shard.save(tmpdir / "copy")
+    assert shard._backend is None
+    labels, _ = shard.knn_query(vectors[:1], k=1)
+    assert labels.tolist() == [[0]]
+    assert isinstance(shard.vectors, np.memmap)
+    assert ExactBackend.load(tmpdir / "copy", "cosine", 8).ids.tolist() == list(range(len(vectors)))
+
+
+def test_quantized_exact_backend(tmpdir):
+    vectors = _vectors(dim=32)
+    ids = np.arange(len(vectors))
+    exact = ExactBackend("cosine", 32)
+    exact.add(vectors, ids)
+    truth, _ = exact.knn_query(vectors[:5], k=10)
+
+    for quantize, dtype in [("float16", np.float16), ("int8", np.int8)]:
+        quantized = ExactBackend("cosine", 32, quantize=quantize, rerank=True)
+        quantized.add(vectors, ids)
+        quantized.save(tmpdir / f"{quantize}.index")
+        loaded = ExactBackend.load(tmpdir / f"{quantize}.index", "cosine", 32)
+        assert loaded.vectors.dtype == dtype and loaded.rerank
+        labels, distances = loaded.knn_query(vectors[:5], k=10)
+        # Re-ranking with the full-precision vectors restores the exact order.
+        np.testing.assert_array_equal(labels, truth)
+        assert distances[:, 0].max() < 1e-5
+
+    int8 = ExactBackend("cosine", 32, quantize="int8")
+    int8.add(vectors, ids)
+    int8.save(tmpdir / "small.index")
+    assert not (tmpdir / "small.index.full.npy").exists()
+    labels, _ = ExactBackend.load(tmpdir / "small.index", "cosine", 32).knn_query(vectors[:5], k=1)
+    assert labels[:, 0].tolist() == list(range(5))
+
+
+def test_int8_scales_grow_on_update(tmpdir):
+    vectors = _vectors(dim=32)
+    ids = np.arange(len(vectors))
+    # The first batch barely uses the first dimensions, the update needs a lot more range there.
+    first, update = vectors[:150].copy(), vectors[150:].copy()
+    first[:, :4] *= 0.01
+    update[:, :4] *= 10
+    int8 = ExactBackend("cosine", 32, quantize="int8")
+    int8.add(first, ids[:150])
+    int8.save(tmpdir / "int8.index")
+    loaded = ExactBackend.load(tmpdir / "int8.index", "cosine", 32)
+    loaded.add(update, ids[150:])
+
+    expected = np.concatenate([first, update])
+    expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+    np.testing.assert_allclose(loaded.get_items(ids), expected, atol=0.02)
+    labels, _ = loaded.knn_query(np.concatenate([first[:5], update[:5]]), k=1)
+    assert labels[:, 0].tolist() == [0, 1, 2, 3, 4, 150, 151, 152, 153, 154]
+
+
+def test_top_k_scores_queries_in_chunks(monkeypatch):
+    vectors = _vectors()
+    queries = _vectors(n=50)[::-1]
+    expected = np.argsort(-(queries @ vectors.T), axis=1, kind="stable")[:, :5]
+    # Blocks of 2 queries against every batch of 64 vectors.
+    monkeypatch.setattr("prodigy_ann.backends.SCORE_BLOCK_SIZE", 128)
+    batches = ((vectors[start:start + 64], np.arange(start, min(start + 64, len(vectors))))
+               for start in range(0, len(vectors), 64))
+    labels, scores = top_k(queries, batches, k=5)
+    np.testing.assert_array_equal(labels, expected)
+    np.testing.assert_allclose(scores, np.take_along_axis(queries @ vectors.T, expected, axis=1), rtol=1e-6)
+
+
+def test_filtered_search():
+    vectors = _vectors()
+    ids = np.arange(len(vectors))
+    allowed = np.arange(0, len(vectors), 3)
+    exact = ExactBackend("cosine", 8)
+    hnsw = HnswBackend("cosine", 8, hnsw_m=16, ef_construction=200, ef=300)
+    exact.add(vectors, ids)
+    hnsw.add(vectors, ids)
+
+    labels, _ = exact.knn_query(vectors[1:2], k=10, allowed=allowed)
+    assert set(labels[0].tolist()) <= set(allowed.tolist())
+    hnsw_labels, _ = hnsw.knn_query(vectors[1:2], k=10, allowed=allowed)
+    np.testing.assert_array_equal(labels, hnsw_labels)
+
+
+def test_maximal_marginal_relevance():
+    query = np.array([1.0, 0.0], dtype=np.float32)
+    # Two near-duplicates close to the query and one different, slightly less relevant vector.
+    vectors = np.array([[1.0, 0.01], [1.0, 0.02], [0.8, 0.6]], dtype=np.float32)
+    assert maximal_marginal_relevance(query, vectors, k=2, diversity=0.0).tolist() == [0, 1]
+    assert maximal_marginal_relevance(query, vectors, k=2, diversity=0.7).tolist() == [0, 2]
+    assert maximal_marginal_relevance(query, vectors, k=5, diversity=0.7).tolist() == [0, 2, 1]
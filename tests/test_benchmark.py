@@ -0,0 +1,18 @@
+import numpy as np
+
+from prodigy_ann.benchmark import benchmark_hnsw, exact_neighbours
+
+
+def test_exact_neighbours():
+    vectors = np.eye(4, dtype=np.float32)
+    queries = np.array([[0.9, 0.1, 0, 0], [0, 0, 0.2, 1]], dtype=np.float32)
+    assert exact_neighbours(vectors, queries, k=2).tolist() == [[0, 1], [3, 2]]
+
+
+def test_benchmark_hnsw():
+    vectors = np.random.default_rng(0).standard_normal((500, 16)).astype(np.float32)
+    results = benchmark_hnsw(vectors, vectors[:20], k=5, efs=[10, 100])
+    assert [r["ef"] for r in results] == [10, 100]
+    # With a candidate list this large a graph of 500 points is searched exhaustively.
+    assert results[-1]["recall@5"] == 1.0
+    assert all(r["latency_ms_p50"] <= r["latency_ms_p99"] for r in results)
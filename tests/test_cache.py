@@ -0,0 +1,48 @@
+import numpy as np
+
+from prodigy_ann.cache import EmbeddingCache
+
+
+def test_cache_roundtrip_and_eviction(tmpdir):
+    cache = EmbeddingCache(tmpdir / "cache.sqlite", "some-model", max_items=3)
+    vectors = np.arange(12, dtype=np.float32).reshape(4, 3)
+    cache.put_many([1, 2, 3], vectors[:3])
+    found = cache.get_many([1, 2, 3, 4])
+    assert set(found) == {1, 2, 3}
+    np.testing.assert_array_equal(found[2], vectors[1])
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    # Touch 2 and 3 so that 1 is the least recently used, then overflow the cache.
+    cache.get_many([2, 3])
+    cache.put_many([4], vectors[3:])
+    assert len(cache) == 3
+    assert set(cache.get_many([1, 2, 3, 4])) == {2, 3, 4}
+    cache.close()
+
+
+def test_cache_counts_rows_on_insert(tmpdir):
+    path = tmpdir / "cache.sqlite"
+    vectors = np.ones((4, 3), dtype=np.float32)
+    cache = EmbeddingCache(path, "some-model", max_items=3)
+    cache.put_many([1, 2], vectors[:2])
+    # Replacing a cached embedding or repeating a hash doesn't add rows, so nothing is evicted.
+    cache.put_many([2, 3, 3], vectors[:3])
+    assert cache._count == len(cache) == 3
+    assert set(cache.get_many([1, 2, 3])) == {1, 2, 3}
+    cache.close()
+
+    # Rows are counted again when the cache is opened, other models count too.
+    cache = EmbeddingCache(path, "other-model", max_items=3)
+    cache.put_many([1], vectors[:1])
+    assert cache._count == len(cache) == 3
+    cache.close()
+
+
+def test_cache_is_keyed_by_model(tmpdir):
+    path = tmpdir / "cache.sqlite"
+    cache = EmbeddingCache(path, "model-a")
+    cache.put_many([1], np.ones((1, 3), dtype=np.float32))
+    cache.close()
+
+    assert EmbeddingCache(path, "model-a").get_many([1])
+    assert not EmbeddingCache(path, "model-b").get_many([1])
@@ -0,0 +1,29 @@
+import numpy as np
+
+from prodigy_ann.chunks import ChunkMap, chunk_spans
+
+
+def test_chunk_spans():
+    assert chunk_spans("Short text.", size=10) == [(0, 11)]
+    assert chunk_spans("", size=10) == [(0, 0)]
+    text = "One two three. Four five six seven. Eight nine ten eleven twelve."
+    # Chunks end after a sentence rather than at exactly `size` words.
+    chunks = [text[start:end] for start, end in chunk_spans(text, size=8)]
+    assert chunks == ["One two three. Four five six seven.", "Eight nine ten eleven twelve."]
+    # Sentences longer than a chunk are split into overlapping windows.
+    text = " ".join(str(i) for i in range(10))
+    chunks = [text[start:end] for start, end in chunk_spans(text, size=4, overlap=1)]
+    assert chunks == ["0 1 2 3", "3 4 5 6", "6 7 8 9"]
+
+
+def test_chunk_map(tmpdir):
+    chunks = ChunkMap()
+    chunks.add([0, 0, 1], [(0, 10), (10, 20), (0, 5)])
+    chunks.add([2], [(0, 7)])
+    assert chunks.docs.tolist() == [0, 0, 1, 2]
+    assert chunks.spans[1].tolist() == [10, 20]
+    assert len(chunks) == 4 and chunks.n_docs == 3
+    chunks.save(tmpdir / "test.index")
+    loaded = ChunkMap.load(tmpdir / "test.index")
+    assert np.array_equal(loaded.docs, chunks.docs) and np.array_equal(loaded.spans, chunks.spans)
+    assert ChunkMap.load(tmpdir / "missing.index") is None
@@ -0,0 +1,29 @@
+import numpy as np
+
+from prodigy_ann.backends import ExactBackend
+from prodigy_ann.clusters import find_clusters, union_pairs
+
+
+def test_union_pairs():
+    roots = union_pairs(np.arange(7), np.array([5, 1, 3, 6]), np.array([3, 4, 1, 6]))
+    assert roots.tolist() == [0, 1, 2, 1, 1, 1, 6]
+    # Pairs that join two existing clusters.
+    assert union_pairs(roots, np.array([6]), np.array([4])).tolist() == [0, 1, 2, 1, 1, 1, 1]
+
+
+def test_find_clusters():
+    rng = np.random.default_rng(0)
+    base = rng.standard_normal((50, 16)).astype(np.float32)
+    # Every fifth vector has two slightly changed copies at the end.
+    copies = base[::5].repeat(2, axis=0) + rng.normal(scale=1e-3, size=(20, 16)).astype(np.float32)
+    vectors = np.concatenate([base, copies])
+    backend = ExactBackend("cosine", 16)
+    backend.add(vectors, np.arange(len(vectors)))
+    roots = find_clusters(backend.knn_query, backend.get_items, len(vectors), threshold=0.01, batch_size=16)
+    assert len(np.unique(roots)) == 50
+    assert roots[50:].tolist() == np.arange(0, 50, 5).repeat(2).tolist()
+    # Adding labels only searches the new ones.
+    backend.add(base[7:8], np.array([70]))
+    updated = find_clusters(backend.knn_query, backend.get_items, len(vectors) + 1, threshold=0.01, roots=roots)
+    assert updated[:70].tolist() == roots.tolist()
+    assert updated[70] == 7
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from prodigy_ann.filters import MetaIndex, parse_filter
+
+
+def test_parse_filter():
+    assert parse_filter("lang=de|en, source=crm") == {"lang": ["de", "en"], "source": ["crm"]}
+    with pytest.raises(ValueError):
+        parse_filter("lang")
+
+
+def test_meta_index(tmpdir):
+    examples = [
+        {"meta": {"lang": "de", "source": "crm"}},
+        {"meta": {"lang": "en", "source": "crm"}},
+        {"meta": {"lang": "de", "source": "web"}},
+        {"meta": {"lang": "fr", "tags": ["a", "b"]}},
+        {"text": "no meta"},
+    ]
+    meta_index = MetaIndex(["lang", "source", "tags"])
+    for label, ex in enumerate(examples):
+        meta_index.add(label, ex)
+    assert meta_index.labels({"lang": ["de"]}).tolist() == [0, 2]
+    assert meta_index.labels({"lang": ["de", "en"], "source": ["crm"]}).tolist() == [0, 1]
+    assert meta_index.labels({"tags": ["b"]}).tolist() == [3]
+    assert meta_index.labels({"lang": ["es"]}).tolist() == []
+
+    meta_index.save(tmpdir / "test.index")
+    loaded = MetaIndex.load(tmpdir / "test.index")
+    loaded.add(5, {"meta": {"lang": "de"}})
+    np.testing.assert_array_equal(loaded.labels({"lang": ["de"]}), [0, 2, 5])
+    with pytest.raises(ValueError):
+        loaded.labels({"date": ["2024"]})
@@ -0,0 +1,44 @@
+import subprocess
+import sys
+
+import pytest
+
+from prodigy_ann.models import load_model, register_model
+
+# Modules that take seconds to import, they should only be loaded once they're used.
+HEAVY_MODULES = ("sentence_transformers", "torch", "hnswlib", "spacy")
+
+
+def test_imports_are_lazy():
+    code = (
+        "import sys, prodigy_ann, prodigy_ann.util, prodigy_ann.backends, prodigy_ann.benchmark; "
+        "import prodigy_ann.text, prodigy_ann.image; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == ""
+
+
+def test_models_are_shared():
+    class Encoder:
+        def encode(self, texts):
+            return [[0.0] for _ in texts]
+
+    encoder = Encoder()
+    register_model("test-encoder", encoder)
+    assert load_model("test-encoder") is encoder
+    assert load_model("test-encoder") is load_model("test-encoder")
+
+
+def test_models_are_shared_per_inference():
+    class Encoder:
+        def encode(self, texts):
+            return [[0.0] for _ in texts]
+
+    full, quantized = Encoder(), Encoder()
+    register_model("test-encoder", full)
+    register_model("test-encoder", quantized, inference="int8")
+    assert load_model("test-encoder") is full
+    assert load_model("test-encoder", "int8") is quantized
+    with pytest.raises(ValueError):
+        load_model("test-encoder", "onnx")
@@ -0,0 +1,40 @@
+import numpy as np
+
+from prodigy_ann.lexical import LexicalIndex, reciprocal_rank_fusion, tokenize
+
+
+TEXTS = [
+    "The printer shows error E-1042 after the update",
+    "How do I reset my password",
+    "Order X1-200.5 arrived damaged",
+    "The printer is out of paper",
+    "Password reset emails never arrive",
+]
+
+
+def test_tokenize_keeps_identifiers():
+    assert tokenize("Error E-1042 on X1-200.5!") == ["error", "e-1042", "on", "x1-200.5"]
+
+
+def test_lexical_index(tmpdir):
+    lexical = LexicalIndex()
+    for label, text in enumerate(TEXTS):
+        lexical.add(label, text)
+    labels, scores = lexical.search("e-1042", k=3)
+    assert labels.tolist() == [0]
+    labels, scores = lexical.search("printer password reset", k=10)
+    assert set(labels.tolist()) == {0, 1, 3, 4}
+    assert (np.diff(scores) <= 0).all()
+    labels, _ = lexical.search("printer", k=10, allowed=np.array([3]))
+    assert labels.tolist() == [3]
+    assert len(lexical.search("unknown", k=3)[0]) == 0
+
+    lexical.save(tmpdir / "test.index")
+    loaded = LexicalIndex.load(tmpdir / "test.index")
+    loaded.add(len(TEXTS), "Order X1-200.5 was lost")
+    assert set(loaded.search("x1-200.5", k=3)[0].tolist()) == {2, 5}
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([np.array([1, 2, 3]), np.array([3, 4])], k=3)
+    assert fused.tolist() == [3, 1, 2]
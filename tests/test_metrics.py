@@ -0,0 +1,45 @@
+import time
+
+import srsly
+
+from prodigy_ann.metrics import Metrics, to_prometheus
+
+
+def test_metrics_stages():
+    metrics = Metrics()
+    with metrics.timer("encode", items=32):
+        time.sleep(0.01)
+    metrics.add("encode", 0.02, items=8)
+    assert list(metrics.timed(range(3), "source_read")) == [0, 1, 2]
+    stats = metrics.as_dict()
+    encode = stats["stages"]["encode"]
+    assert encode["calls"] == 2
+    assert encode["items"] == 40
+    assert encode["seconds"] >= 0.03
+    assert encode["max_seconds"] >= 0.02
+    assert stats["stages"]["source_read"]["calls"] == 3
+
+
+def test_metrics_write(tmp_path):
+    metrics = Metrics()
+    metrics.add("knn_query", 0.5)
+    metrics.write(tmp_path / "stats.jsonl")
+    metrics.write(tmp_path / "stats.jsonl")
+    records = list(srsly.read_jsonl(tmp_path / "stats.jsonl"))
+    assert len(records) == 2
+    assert records[0]["stages"]["knn_query"]["seconds"] == 0.5
+    metrics.write(tmp_path / "stats.prom")
+    text = (tmp_path / "stats.prom").read_text()
+    assert 'prodigy_ann_stage_seconds_total{stage="knn_query"} 0.5' in text
+    assert "# TYPE prodigy_ann_peak_rss_bytes gauge" in text
+
+
+def test_to_prometheus():
+    stats = {"uptime_seconds": 2.0, "rss": None, "peak_rss": 1024, "stages": {
+        "encode": {"calls": 2, "items": 64, "seconds": 1.5, "max_seconds": 1.0, "peak_rss_growth": 0},
+    }}
+    lines = to_prometheus(stats).splitlines()
+    assert 'prodigy_ann_stage_items_total{stage="encode"} 64' in lines
+    assert "prodigy_ann_peak_rss_bytes 1024" in lines
+    # Unknown values are left out rather than reported as zero.
+    assert not any(line.startswith("prodigy_ann_rss_bytes") for line in lines)
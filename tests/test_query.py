@@ -0,0 +1,38 @@
+from prodigy_ann.query import QueryPart, is_multi_query, parse_query, unescape
+
+
+def test_parse_query():
+    parts = parse_query("printer jam; paper tray^0.5; -toner; @1234")
+    assert parts == [
+        QueryPart("printer jam", None),
+        QueryPart("paper tray", None, 0.5),
+        QueryPart("toner", None, negative=True),
+        QueryPart(None, 1234),
+    ]
+    assert parse_query("-@7^2;;") == [QueryPart(None, 7, 2.0, True)]
+
+
+def test_is_multi_query():
+    assert not is_multi_query("benchmarks on gpu")
+    assert not is_multi_query("error e-404 ")
+    assert is_multi_query("benchmarks; -gpu")
+    assert is_multi_query("gpu^2")
+    assert is_multi_query("@12")
+    assert is_multi_query("benchmarks; @12")
+    # Plain texts separated by `;` are combined with equal weights.
+    assert is_multi_query("printer jam; paper tray")
+    assert is_multi_query("printer jam^1; paper tray^1")
+    assert is_multi_query("a; b^1.0")
+
+
+def test_plain_queries():
+    # Queries without a positive part or with a single part without operators are searched as they are.
+    assert not is_multi_query("")
+    assert not is_multi_query("-v flag alpha")
+    assert not is_multi_query("-gpu; -cpu")
+    assert not is_multi_query(r"printer jammed\; then it stopped")
+    # Escaped characters are text, the backslashes are removed before encoding.
+    assert not is_multi_query(r"C\; -gpu")
+    assert parse_query(r"C\; x\^2") == [QueryPart(r"C\; x\^2", None)]
+    assert parse_query(r"jam; \@12") == [QueryPart("jam", None), QueryPart(r"\@12", None)]
+    assert unescape(r"C\; x\^2 \-v \@12") == "C; x^2 -v @12"
@@ -2,6 +2,7 @@ import pytest
 import srsly 
 from pathlib import Path 
 from prodigy_ann.text import text_index, text_fetch, textcat_ann_manual, ner_ann_manual, spans_ann_manual
+from prodigy_ann.util import ApproximateIndex
 
 
 def test_basics(tmpdir):
@@ -35,3 +36,290 @@ def test_basics(tmpdir):
     assert isinstance(out, dict)
     assert next(out['stream'])
 
+
+
+def test_index_with_cache(tmpdir):
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = tmpdir / "new-dataset.index"
+    cache_path = tmpdir / "cache.sqlite"
+    fetch_path = tmpdir / "fetched.jsonl"
+
+    # The second run should be served entirely from the cache and give the same results.
+    text_index(examples_path, index_path, cache_path=cache_path)
+    text_fetch(examples_path, index_path, fetch_path, query="benchmarks", n=10)
+    first = list(srsly.read_jsonl(fetch_path))
+    text_index(examples_path, index_path, cache_path=cache_path)
+    text_fetch(examples_path, index_path, fetch_path, query="benchmarks", n=10)
+    second = list(srsly.read_jsonl(fetch_path))
+    assert [ex["text"] for ex in first] == [ex["text"] for ex in second]
+
+
+def test_index_update(tmpdir, capsys):
+    examples = list(srsly.read_jsonl("tests/datasets/new-dataset.jsonl"))
+    examples_path = tmpdir / "examples.jsonl"
+    index_path = tmpdir / "new-dataset.index"
+    fetch_path = tmpdir / "fetched.jsonl"
+
+    srsly.write_jsonl(examples_path, examples[:1000])
+    text_index(examples_path, index_path)
+
+    # Only the new examples get added, the existing labels keep pointing to the same examples.
+    srsly.write_jsonl(examples_path, examples[1000:] + examples[:1000])
+    capsys.readouterr()
+    text_index(examples_path, index_path, update=True)
+    # The source changed, but that's what the update is for.
+    assert "has changed" not in capsys.readouterr().out
+    text_fetch(examples_path, index_path, fetch_path, query="benchmarks", n=len(examples) - 10)
+    fetched = list(srsly.read_jsonl(fetch_path))
+    assert len({ex["text"] for ex in fetched}) == len(fetched)
+
+
+def test_index_update_without_new_examples(tmpdir):
+    examples_path = tmpdir / "examples.jsonl"
+    index_path = tmpdir / "new-dataset.index"
+    fetch_path = tmpdir / "fetched.jsonl"
+    srsly.write_jsonl(examples_path, list(srsly.read_jsonl("tests/datasets/new-dataset.jsonl"))[:300])
+    text_index(examples_path, index_path)
+    assert srsly.read_json(f"{index_path}.meta.json")["backend"] == "exact"
+
+    # Storing the index again replaces the files its vectors are mapped from.
+    text_index(examples_path, index_path, update=True)
+    text_fetch(examples_path, index_path, fetch_path, query="benchmarks", n=10)
+    assert len(list(srsly.read_jsonl(fetch_path))) == 10
+
+
+def test_fetch_uses_example_store(tmpdir):
+    examples_path = tmpdir / "examples.jsonl"
+    index_path = tmpdir / "new-dataset.index"
+    fetch_path = tmpdir / "fetched.jsonl"
+    srsly.write_jsonl(examples_path, srsly.read_jsonl("tests/datasets/new-dataset.jsonl"))
+    text_index(examples_path, index_path)
+
+    # Examples are resolved from the store that's written next to the index, not the source.
+    examples_path.remove()
+    text_fetch(examples_path, index_path, fetch_path, query="benchmarks", n=10)
+    assert len(list(srsly.read_jsonl(fetch_path))) == 10
+
+
+def test_index_bundle_metadata(tmpdir):
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = tmpdir / "new-dataset.index"
+    text_index(examples_path, index_path)
+
+    meta = srsly.read_json(f"{index_path}.meta.json")
+    assert meta["model_name"] == "all-MiniLM-L6-v2"
+    assert meta["dim"] == 384
+    assert meta["count"] == len(list(srsly.read_jsonl(examples_path)))
+    assert meta["source_fingerprint"]
+    assert meta["hnsw"] == {"M": 16, "ef_construction": 200, "ef": 10}
+    # Small sources are searched exactly unless a backend is picked explicitly.
+    assert meta["backend"] == "exact"
+
+    # The model is only loaded once a query needs to be encoded.
+    index = ApproximateIndex("all-MiniLM-L6-v2", examples_path, index_path)
+    assert index._model is None
+    assert next(index.new_stream("benchmarks", n=10))
+
+
+def test_index_model_mismatch(tmpdir):
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = tmpdir / "new-dataset.index"
+    fetch_path = tmpdir / "fetched.jsonl"
+    text_index(examples_path, index_path, batch_size=32)
+    assert srsly.read_json(f"{index_path}.meta.json")["inference"] == "torch"
+
+    # Without a model, the one the index was built with is used, another model is refused.
+    index = ApproximateIndex(None, examples_path, index_path)
+    assert index.model_name == "all-MiniLM-L6-v2"
+    text_fetch(examples_path, index_path, fetch_path, query="benchmarks", n=10)
+    with pytest.raises(SystemExit):
+        text_fetch(examples_path, index_path, fetch_path, query="benchmarks", n=10, model="clip-ViT-B-32")
+
+
+def test_sharded_index(tmpdir):
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = tmpdir / "new-dataset.index"
+    fetch_path = tmpdir / "fetched.jsonl"
+    text_index(examples_path, index_path, shards=3)
+
+    meta = srsly.read_json(f"{index_path}.meta.json")
+    assert len(meta["shards"]) == 3
+    assert sum(meta["shard_counts"]) == meta["count"]
+    # Shards are loaded when they're first searched.
+    index = ApproximateIndex(None, examples_path, index_path)
+    assert all(shard._backend is None for shard in index.shards)
+    # Results from all shards are merged by distance.
+    text_fetch(examples_path, index_path, fetch_path, query="benchmarks", n=50)
+    distances = [ex["meta"]["distance"] for ex in srsly.read_jsonl(fetch_path)]
+    assert len(distances) == 50
+    assert distances == sorted(distances)
+
+
+def test_query_cache(tmpdir):
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = tmpdir / "new-dataset.index"
+    text_index(examples_path, index_path)
+
+    index = ApproximateIndex("all-MiniLM-L6-v2", examples_path, index_path, query_cache_size=1)
+    first = index.search("benchmarks", n=10)
+    assert index.search("benchmarks", n=10) is first
+    # Only the most recent query is kept around.
+    index.search("corpus", n=10)
+    assert index.search("benchmarks", n=10) is not first
+
+
+def test_fetch_queries_file(tmpdir):
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = tmpdir / "new-dataset.index"
+    queries_path = tmpdir / "queries.txt"
+    queries_path.write_text("benchmarks\ncorpus\n", encoding="utf8")
+    text_index(examples_path, index_path)
+
+    out_dir = tmpdir / "fetched"
+    text_fetch(examples_path, index_path, out_dir, queries=queries_path, n=10)
+    assert len(out_dir.listdir()) == 2
+
+    combined_path = tmpdir / "combined.jsonl"
+    text_fetch(examples_path, index_path, combined_path, queries=queries_path, n=10, combine=True)
+    combined = list(srsly.read_jsonl(combined_path))
+    assert len({ex["_input_hash"] for ex in combined}) == len(combined)
+    assert all(set(ex["meta"]["queries"]) <= {"benchmarks", "corpus"} for ex in combined)
+
+
+def test_new_stream_starts_before_full_search(tmpdir):
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = tmpdir / "new-dataset.index"
+    text_index(examples_path, index_path)
+
+    index = ApproximateIndex("all-MiniLM-L6-v2", examples_path, index_path)
+    stream = index.new_stream("benchmarks", n=50, first=5)
+    first = [next(stream) for _ in range(5)]
+    progressive = first + list(stream)
+    # Once cached, the full result comes straight from the search.
+    assert index.query_results.get(("benchmarks", 50, None)) is not None
+    cached = list(index.new_stream("benchmarks", n=50))
+    assert [ex["_task_hash"] for ex in progressive] == [ex["_task_hash"] for ex in cached]
+
+
+def test_diverse_stream_matches_ranked(tmpdir):
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = tmpdir / "new-dataset.index"
+    text_index(examples_path, index_path)
+
+    # A separate index without a query cache, so both rank from scratch.
+    index = ApproximateIndex("all-MiniLM-L6-v2", examples_path, index_path)
+    reference = ApproximateIndex("all-MiniLM-L6-v2", examples_path, index_path, query_cache_size=0)
+    excluded = [ex["_input_hash"] for ex in index.new_stream("benchmarks", n=8)]
+    index.exclude(excluded)
+    reference.exclude(excluded)
+    stream = list(index.new_stream("benchmarks", n=50, diversity=0.5))
+    labels, _ = reference.ranked("benchmarks", n=50, diversity=0.5)
+    assert [ex["meta"]["index"] for ex in stream] == labels.tolist()
+
+
+def test_new_stream_skips_excluded(tmpdir):
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = tmpdir / "new-dataset.index"
+    text_index(examples_path, index_path)
+
+    index = ApproximateIndex("all-MiniLM-L6-v2", examples_path, index_path)
+    top = list(index.new_stream("benchmarks", n=20))
+    index.exclude(ex["_input_hash"] for ex in top[:15])
+    fresh = list(index.new_stream("benchmarks", n=20))
+    assert len(fresh) == 20
+    assert not {ex["_input_hash"] for ex in fresh} & {ex["_input_hash"] for ex in top[:15]}
+    assert [ex["_input_hash"] for ex in fresh[:5]] == [ex["_input_hash"] for ex in top[15:]]
+
+
+def test_multi_query(tmpdir):
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = tmpdir / "new-dataset.index"
+    text_index(examples_path, index_path)
+
+    index = ApproximateIndex("all-MiniLM-L6-v2", examples_path, index_path)
+    top = list(index.new_stream("benchmarks", n=10))
+    label = top[0]["meta"]["index"]
+    similar = list(index.new_stream(f"@{label}", n=10))
+    assert similar[0]["meta"]["index"] == label
+    mixed = list(index.new_stream(f"benchmarks; -@{label}^2", n=10))
+    assert label not in {ex["meta"]["index"] for ex in mixed[:5]}
+
+
+def test_index_clusters_duplicates(tmpdir):
+    examples_path = tmpdir / "duplicates.jsonl"
+    examples = list(srsly.read_jsonl("tests/datasets/new-dataset.jsonl"))
+    # The same text from different sources, the copies are separate examples.
+    srsly.write_jsonl(examples_path, examples + [dict(ex, meta={"copy": True}) for ex in examples[:20]])
+    index_path = tmpdir / "duplicates.index"
+    text_index(examples_path, index_path, dedup_threshold=0.001)
+
+    index = ApproximateIndex("all-MiniLM-L6-v2", examples_path, index_path)
+    assert len(index.clusters) == len(examples) + 20
+    stream = list(index.new_stream(examples[0]["text"], n=30))
+    assert len(stream) == 30
+    assert len({ex["text"] for ex in stream}) == 30
+
+
+def test_chunked_index(tmpdir):
+    examples = list(srsly.read_jsonl("tests/datasets/new-dataset.jsonl"))
+    # Long documents made of many examples, with the query text deep inside one of them.
+    docs = [{"text": " ".join(ex["text"] for ex in examples[i:i + 50])} for i in range(0, 1000, 50)]
+    examples_path = tmpdir / "docs.jsonl"
+    srsly.write_jsonl(examples_path, docs)
+    index_path = tmpdir / "docs.index"
+    text_index(examples_path, index_path, chunk_words=64)
+
+    index = ApproximateIndex("all-MiniLM-L6-v2", examples_path, index_path)
+    assert len(index) > len(docs)
+    assert index.chunks.n_docs == len(docs)
+    query = examples[420]["text"]
+    stream = list(index.new_stream(query, n=5))
+    # Every document shows up once, with the offsets of the chunk that matched best.
+    assert len({ex["text"] for ex in stream}) == 5
+    assert query in stream[0]["text"]
+    start, end = stream[0]["meta"]["passage"]
+    position = stream[0]["text"].index(query)
+    assert start < position + len(query) and position < end
+
+    out = spans_ann_manual("xxx", "blank:en", examples_path, index_path, labels="foo,bar", query=query, n=5)
+    assert "passage" in next(out["stream"])["meta"]
+    out = ner_ann_manual("xxx", "blank:en", examples_path, index_path, labels="foo,bar", query=query, n=5)
+    assert "passage" in next(out["stream"])["meta"]
+    # Annotators can get only the passage that matched, the offsets still point into the document.
+    out = spans_ann_manual(
+        "xxx", "blank:en", examples_path, index_path, labels="foo,bar", query=query, n=5, passages=True
+    )
+    task = next(out["stream"])
+    start, end = task["meta"]["passage"]
+    assert query in task["text"]
+    assert end - start == len(task["text"])
+
+
+def test_index_without_metadata():
+    # Indexes built before the metadata was stored don't know their model.
+    examples_path = Path("tests/datasets/new-dataset.jsonl")
+    index_path = Path("tests/datasets/new-dataset.index")
+    with pytest.raises(ValueError):
+        ApproximateIndex(None, examples_path, index_path)
+    index = ApproximateIndex(None, examples_path, index_path, default_model="all-MiniLM-L6-v2")
+    assert index.model_name == "all-MiniLM-L6-v2"
+    assert next(index.new_stream("benchmarks", n=10))
+    out = textcat_ann_manual("xxx", examples_path, index_path, labels="foo,bar", query="benchmarks")
+    assert next(out["stream"])
+
+
+def test_auto_backend_switches_on_update(tmpdir, monkeypatch):
+    monkeypatch.setattr("prodigy_ann.util.EXACT_THRESHOLD", 500)
+    examples = list(srsly.read_jsonl("tests/datasets/new-dataset.jsonl"))
+    examples_path = tmpdir / "examples.jsonl"
+    index_path = tmpdir / "new-dataset.index"
+    srsly.write_jsonl(examples_path, examples[:400])
+    text_index(examples_path, index_path)
+    meta = srsly.read_json(f"{index_path}.meta.json")
+    assert (meta["backend"], meta["backend_mode"]) == ("exact", "auto")
+
+    # The index remembers it was built with "auto", so growing it past the threshold switches to hnswlib.
+    srsly.write_jsonl(examples_path, examples)
+    text_index(examples_path, index_path, update=True)
+    meta = srsly.read_json(f"{index_path}.meta.json")
+    assert (meta["backend"], meta["backend_mode"]) == ("hnsw", "auto")
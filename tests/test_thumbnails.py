@@ -0,0 +1,42 @@
+import base64
+import io
+
+from PIL import Image
+
+from prodigy_ann.thumbnails import ThumbnailCache, load_image
+
+
+def _photo(path, size=(1200, 800)):
+    Image.new("RGB", size, color=(200, 30, 30)).save(path, format="JPEG")
+    return path
+
+
+def test_load_image_reduces_to_model_size(tmpdir):
+    path = _photo(tmpdir / "photo.jpg")
+    image = load_image({"path": str(path)})
+    assert image.mode == "RGB"
+    assert image.size == (336, 224)
+    # Small images are left alone.
+    assert load_image({"path": str(_photo(tmpdir / "small.jpg", (100, 50)))}).size == (100, 50)
+
+
+def test_load_image_from_base64():
+    buffer = io.BytesIO()
+    Image.new("RGB", (448, 448)).save(buffer, format="PNG")
+    data = base64.b64encode(buffer.getvalue()).decode("utf8")
+    assert load_image({"image": f"data:image/png;base64,{data}"}).size == (224, 224)
+    assert load_image({"image": data, "path": "missing.png"}).size == (224, 224)
+
+
+def test_thumbnail_cache(tmpdir):
+    path = _photo(tmpdir / "photo.jpg")
+    thumbnails = ThumbnailCache(tmpdir / "thumbnails")
+    first = load_image({"path": str(path)}, thumbnails=thumbnails)
+    second = load_image({"path": str(path)}, thumbnails=thumbnails)
+    assert (thumbnails.hits, thumbnails.misses) == (1, 1)
+    assert first.tobytes() == second.tobytes()
+
+    # Changing the file invalidates its thumbnail.
+    _photo(path, (600, 1200))
+    assert load_image({"path": str(path)}, thumbnails=thumbnails).size == (224, 448)
+    assert thumbnails.misses == 2